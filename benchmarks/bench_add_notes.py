@@ -0,0 +1,59 @@
+"""
+Note insertion throughput of one add_note call per note against
+add_note_to_deck, which sends them in chunks to add_notes.
+
+    python benchmarks/bench_add_notes.py [counts...]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "libs"))
+
+from anki.collection import Collection  # noqa: E402
+from src.utils import create_model  # noqa: E402
+from src.utils import UndoStep, add_note_to_deck  # noqa: E402
+
+
+def one_by_one(notes, model, did, collection):
+    for recto, verso, card_hash in notes:
+        note = collection.new_note(model)
+        note.fields[0] = recto
+        note.fields[1] = verso
+        note.fields[2] = card_hash
+        collection.add_note(note, did)
+
+
+def bulk(notes, model, did, collection):
+    with UndoStep(collection):
+        add_note_to_deck(notes, model["id"], did, collection)
+
+
+def run(fn, count):
+    with tempfile.TemporaryDirectory() as folder:
+        collection = Collection(os.path.join(folder, "collection.anki2"))
+        collection.models.save(create_model(collection))
+        model = collection.models.by_name("Ankill")
+        did = collection.decks.id_for_name("Default")
+        notes = [(f"<h2>{n}</h2>", f"<p>{n}</p>", f"{n:0128x}") for n in range(count)]
+        start = time.perf_counter()
+        fn(notes, model, did, collection)
+        elapsed = time.perf_counter() - start
+        collection.close()
+    return elapsed
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or [1000, 10000, 50000]
+    for count in counts:
+        for name, fn in (("add_note", one_by_one), ("add_notes", bulk)):
+            elapsed = run(fn, count)
+            print(f"{count:>6} notes {name:>9}: {elapsed:7.2f}s {count / elapsed:9.0f} notes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Update time and accuracy of the two strategies of Diff for modified files:
+the hunks of the diff (ModifiedFile) against the cards of both versions (CardSetFile).
+Every modified card file of the last commits of a card repository is replayed
+on a deck filled from its old version. A strategy is exact on a file when
+the deck ends with the cards of the new version.
+
+    python benchmarks/bench_diff_strategy.py [repository] [commits]
+
+Without a repository, a history of random edits of one file is generated.
+"""
+
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "libs"))
+
+from anki.collection import Collection  # noqa: E402
+from unidiff import PatchSet  # noqa: E402
+from src.utils import create_model  # noqa: E402
+from src.diff import CardSetFile, ModifiedFile, apply_plan  # noqa: E402
+from src.gen_md import DeckGenerator, MdFile  # noqa: E402
+from src.git import Git, deck_pathspecs  # noqa: E402
+from src.plan import PlanBuilder  # noqa: E402
+from src.utils import add_note_to_deck, get_note_hashes  # noqa: E402
+
+
+def git(folder, *args):
+    return subprocess.run(["git", "-C", folder] + list(args), capture_output=True, check=True).stdout
+
+
+def generate_history(folder, commits):
+    random.seed(0)
+    git(folder, "init", "-q")
+    os.mkdir(os.path.join(folder, "deck"))
+    cards = [f"## Card {n}\nAnswer {n}\n" for n in range(300)]
+    for commit in range(commits):
+        for _ in range(5):
+            n = random.randrange(len(cards))
+            cards[n] = cards[n].rstrip("\n") + " edited\n"
+        cards.insert(random.randrange(len(cards)), f"## New {commit}\nAnswer\n")
+        cards.pop(random.randrange(len(cards)))
+        with open(os.path.join(folder, "deck", "cards.md"), "w") as f:
+            f.write("\n".join(cards))
+        git(folder, "add", ".")
+        git(folder, "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-q", "-m", str(commit))
+
+
+def modified_files(folder, commits):
+    """
+    (from source, to source, patch) of the card files modified by the last commits
+    """
+    revs = git(folder, "rev-list", "--first-parent", f"--max-count={commits + 1}", "HEAD").decode().split()
+    files = []
+    os.chdir(folder)
+    with Git() as g:
+        for (rev_to, rev_from) in zip(revs, revs[1:]):
+            changes = [c for c in g.diff_raw(rev_from, rev_to, deck_pathspecs()) if c.status == "M"]
+            sources = g.show_many([c.old_oid for c in changes] + [c.new_oid for c in changes])
+            for change in changes:
+                patch = PatchSet(g.diff_blobs(change.old_oid, change.new_oid))
+                files.append((sources[change.old_oid], sources[change.new_oid], patch[0]))
+    return files
+
+
+def run(strategy, files, collection):
+    model = collection.models.by_name("Ankill")
+    elapsed = 0
+    exact = 0
+    for (n, (from_source, to_source, patch)) in enumerate(files):
+        deck = collection.decks.get(collection.decks.id(f"{strategy} {n}"))
+        notes = DeckGenerator(deck["id"], collection).gen_decks(from_source)
+        add_note_to_deck(notes, model["id"], deck["id"], collection)
+
+        start = time.perf_counter()
+        changes = PlanBuilder()
+        if strategy == "cards":
+            CardSetFile(from_source, to_source, deck["name"], changes).update()
+        else:
+            ModifiedFile(from_source, to_source, patch, deck["name"], changes).update()
+        apply_plan(changes.build(), collection)
+        elapsed += time.perf_counter() - start
+
+        expected = {card.hash for card in MdFile(to_source).cards}
+        exact += set(get_note_hashes(deck["id"], collection)) == expected
+    return (elapsed, exact)
+
+
+def main():
+    commits = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as folder:
+        repository = os.path.realpath(sys.argv[1]) if len(sys.argv) > 1 else os.path.join(folder, "repo")
+        if len(sys.argv) <= 1:
+            os.mkdir(repository)
+            generate_history(repository, commits)
+        files = modified_files(repository, commits)
+
+        collection = Collection(os.path.join(folder, "collection.anki2"))
+        collection.models.save(create_model(collection))
+        for strategy in ("hunks", "cards"):
+            (elapsed, exact) = run(strategy, files, collection)
+            print(f"{strategy:>5}: {len(files)} files {elapsed:7.2f}s, exact on {exact}/{len(files)}")
+        collection.close()
+
+
+if __name__ == "__main__":
+    main()
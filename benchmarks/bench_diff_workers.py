@@ -0,0 +1,56 @@
+"""
+Planning time of a sync touching many files, on this thread and on pools of workers.
+A repository of generated deck files is edited in one commit, then planned with each workers count.
+
+    python benchmarks/bench_diff_workers.py [files] [cards per file]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "libs"))
+
+from src.diff import Diff  # noqa: E402
+
+
+def git(folder, *args):
+    return subprocess.run(["git", "-C", folder] + list(args), capture_output=True, check=True).stdout
+
+
+def write_deck(folder, files, cards, suffix):
+    for n in range(files):
+        with open(os.path.join(folder, "deck", f"file {n}.md"), "w") as f:
+            f.write("\n".join(
+                f"## Card {n}.{c}{suffix}\nSome *text*, a [link](https://example.com) and `code`.\n\n"
+                f"- a list\n- of items\n\n$$x^{c} + y$$\n"
+                for c in range(cards)
+            ))
+    git(folder, "add", ".")
+    git(folder, "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-q", "-m", suffix or "initial")
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cards = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as folder:
+        git(folder, "init", "-q")
+        os.mkdir(os.path.join(folder, "deck"))
+        write_deck(folder, files, cards, "")
+        write_deck(folder, files, cards, " edited")
+        os.chdir(folder)
+
+        for workers in sorted({0, 2, 4, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            plan = Diff("HEAD~1", "HEAD", strategy="cards", workers=workers).plan()
+            elapsed = time.perf_counter() - start
+            updates = sum(len(changes.updates) for (_, changes) in plan.decks)
+            print(f"{workers:>3} workers: {files} files {elapsed:6.2f}s, {updates} updates")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Per-card overhead of building a markdown engine for every card against
+reusing the shared one, and of converting recto and verso separately
+against rendering them from one document.
+
+    python benchmarks/bench_engine.py [cards]
+"""
+
+import os
+import sys
+import timeit
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "libs"))
+
+from src.gen_md import CardGenerator, new_markdown  # noqa: E402
+
+card = """## Blahaj
+A lovely shark
+$$ a = b $$
+
+| P   | ¬P  |
+|-----|-----|
+|  0  |  1  |"""
+
+
+def per_card_engine():
+    CardGenerator(markdown=new_markdown(), single_parse=False).gen_note(card)
+
+
+def shared_engine():
+    CardGenerator(single_parse=False).gen_note(card)
+
+
+def single_parse():
+    CardGenerator().gen_note(card)
+
+
+def main():
+    cards = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    runs = (
+        ("per-card engine", per_card_engine),
+        ("shared engine", shared_engine),
+        ("single parse", single_parse),
+    )
+    for name, fn in runs:
+        total = min(timeit.repeat(fn, number=cards, repeat=3))
+        print(f"{name:>16}: {total / cards * 1e6:8.1f} us/card")
+
+
+if __name__ == "__main__":
+    main()
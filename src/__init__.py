@@ -2,24 +2,27 @@ import sys
 import os
 import anki
 import pathlib
-from aqt import mw, gui_hooks
-from aqt.utils import showWarning
-from aqt.operations import QueryOp
+from typing import Union
+from concurrent.futures import as_completed
+try:
+    from aqt import mw, gui_hooks
+    from aqt.utils import showWarning
+    from aqt.operations import QueryOp
+except ImportError:  # pragma: no cover
+    # Imported outside of Anki, by the command line of __main__.py
+    mw = None
+    gui_hooks = None
 
 sys.path.insert(0, str(pathlib.Path(os.path.dirname(__file__)) / ".." / "libs"))
 
-from .utils import add_note_to_deck
-from .gen_md import DeckGenerator
+from .utils import UndoStep, add_note_to_deck, create_model, get_note_hashes
+from .gen_md import (
+    DeckGenerator, open_render_cache, close_render_cache, can_fork, worker_pool, gen_files, cache_renders,
+)
 from .diff import Diff
-from .git import Git
+from .git import Git, deck_pathspecs, is_deck_synced, open_blob_cache, close_blob_cache
 from .migrator import migrate_old_card
 
-static_html = """
-<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.css" integrity="sha384-nB0miv6/jRmo5UMMR1wu3Gz6NLsoTkbqJghGIsx//Rlm+ZU03BU6SQNC66uf4l5+" crossorigin="anonymous">
-<script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.js" integrity="sha384-7zkQWkzuo3B5mTepMUcHkMB5jZaolc2xDwL6VFqjFALcbeS9Ggm/Yr2r3Dy4lfFg" crossorigin="anonymous"></script>
-<script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/contrib/auto-render.min.js" integrity="sha384-43gviWU0YVjaDtb/GhzOouOXtZMP/7XUzwPTstBeZFe/+rCMvRwr4yROQP43s0Xk" crossorigin="anonymous" onload="renderMathInElement(document.body);"></script>
-"""
-
 
 def get_config():  # pragma: no cover
     if "pytest" in sys.modules:
@@ -31,38 +34,64 @@ def get_config():  # pragma: no cover
 addon_path = pathlib.Path(os.path.dirname(__file__))
 user_files = addon_path / "user_files"
 card_folder = user_files / "cards/"
+render_cache_file = user_files / "render_cache.sqlite"
+blob_cache_file = user_files / "blob_cache.sqlite"
 
 
-def init_deck(deck: anki.decks.Deck, folder: pathlib.Path, collection: anki.collection.Collection):
-    migrate_old_card(deck, folder, collection)
-    model = collection.models.by_name("Ankill")
-    deck_gen = DeckGenerator(deck["id"], collection)
+def read_md_files(folder: pathlib.Path) -> [str]:
+    sources = []
     for entry in folder.iterdir():
         filename, fileext = os.path.splitext(entry)
         if entry.is_file() and fileext == ".md":
             with open(entry, "r") as file:
-                notes = deck_gen.gen_decks(file.read())
-                add_note_to_deck(notes, model["id"], deck["id"], collection)
-
-
-def create_model(collection):
-    model = collection.models.new("Ankill")
-    recto = collection.models.new_field("Recto")
-    collection.models.add_field(model, recto)
-    verso = collection.models.new_field("Verso")
-    collection.models.add_field(model, verso)
-    card_hash = collection.models.new_field("Hash")
-    card_hash["collapsed"] = True
-    collection.models.add_field(model, card_hash)
-    template = collection.models.new_template("Carte")
-    template["qfmt"] = "{{Recto}}" + static_html
-    template["afmt"] = "{{FrontSide}}\n\n<hr id=answer>\n\n{{Verso}}"
-    collection.models.add_template(model, template)
-    return model
+                sources.append(file.read())
+    return sources
+
+
+def init_deck(deck: anki.decks.Deck, folder: pathlib.Path, collection: anki.collection.Collection):
+    migrate_old_card(deck, folder, collection)
+    model = collection.models.by_name("Ankill")
+    hash_notes = get_note_hashes(deck["id"], collection)
+    deck_gen = DeckGenerator(deck["id"], collection, hash_notes)
+    for source in read_md_files(folder):
+        notes = deck_gen.gen_decks(source)
+        note_ids = add_note_to_deck(notes, model["id"], deck["id"], collection)
+        hash_notes.update(zip([card_hash for (_, _, card_hash) in notes], note_ids))
+
+
+def init_decks_in_pool(decks: [(anki.decks.Deck, pathlib.Path)], collection: anki.collection.Collection, workers: int):
+    """
+    Parse and render the cards of the decks on a pool of processes,
+    the notes are written by the calling thread as the results come back
+    """
+    model = collection.models.by_name("Ankill")
+    with worker_pool(workers) as executor:
+        futures = {}
+        for deck, folder in decks:
+            migrate_old_card(deck, folder, collection)
+            hash_notes = get_note_hashes(deck["id"], collection)
+            sources = read_md_files(folder)
+            # At most one task per worker and per deck, the hashes are sent with each task
+            for n in range(min(workers, len(sources))):
+                future = executor.submit(gen_files, sources[n::workers], frozenset(hash_notes))
+                futures[future] = (deck, hash_notes)
+
+        for future in as_completed(futures):
+            (deck, hash_notes) = futures[future]
+            (notes, renders) = future.result()
+            cache_renders(renders)
+            # A card may be in several files of the deck
+            notes = [note for note in notes if note[2] not in hash_notes]
+            note_ids = add_note_to_deck(notes, model["id"], deck["id"], collection)
+            hash_notes.update(zip([card_hash for (_, _, card_hash) in notes], note_ids))
 
 
 def update_repo(_):  # pragma: no cover
     os.chdir(card_folder)
+    config = get_config() or {}
+    if config.get("sync", "pull") == "fetch":
+        return fetch_repo()
+
     pull = Git().pull()
     if not pull.startswith("Updat"):
         print("No update. Nice no work to do so")
@@ -74,29 +103,106 @@ def update_repo(_):  # pragma: no cover
     return update.strip("Updating ").split("..")
 
 
+def fetch_repo():
+    """
+    Fetch the card repository without touching the working tree,
+    the revisions to update the cards from and to are those of HEAD and its upstream
+    """
+    with Git() as git:
+        if not git.fetch():
+            print("Fetch of the card repository failed")
+            return None
+
+        rev_from = git.rev_parse("HEAD")
+        rev_to = git.rev_parse("@{u}")
+        if rev_from is None or rev_to is None or rev_from == rev_to:
+            print("No update. Nice no work to do so")
+            return None
+
+        if not git.is_ancestor(rev_from, rev_to):
+            # Like a pull, which would make a merge commit
+            print(f"WARN: {rev_to} is not a fast-forward of {rev_from}")
+            return None
+
+    return (rev_from, rev_to)
+
+
+def sync_cards(x):  # pragma: no cover
+    refresh_card(x)
+    config = get_config() or {}
+    if x is not None and config.get("sync", "pull") == "fetch":
+        os.chdir(card_folder)
+        # The cards are up to date, the files can follow
+        Git().fast_forward(x[1])
+
+
 def refresh_card(x, collection=None):
     if x is None:  # pragma: no cover
         return
     collection = mw.col if collection is None else collection
+    config = get_config() or {}
     (rev_from, rev_to) = x
-    Diff(rev_from, rev_to, collection).update_deck_and_notes()
+    pathspecs = deck_pathspecs(config.get("decks"), config.get("exclude_decks", []))
+    Diff(
+        rev_from, rev_to, collection, config.get("diff_source", "patch"), pathspecs,
+        config.get("diff_strategy", "cards"), config.get("sync_workers", 0),
+    ).update_deck_and_notes()
 
 
-def create_decks(path_folder: pathlib.Path, already_exists: [str], collection):
+def create_decks(path_folder: pathlib.Path, already_exists: [str], collection, include=None, exclude=()):
+    """
+        include, exclude: names of the deck folders synced, all of them when include is None
+    """
     for folder in path_folder.iterdir():
         name = folder.name
-        if folder.is_dir() and not name.startswith("."):
+        if folder.is_dir() and not name.startswith(".") and is_deck_synced(name, include, exclude):
             if name.lower() not in already_exists:
                 nd = collection.decks.new_deck()
                 nd.name = name
                 collection.decks.add_deck(nd)
 
 
-def fill_decks(path_folder: pathlib.Path, already_exists: [str], collection: anki.collection.Collection):
+def fill_decks(path_folder: pathlib.Path, already_exists: [str], collection: anki.collection.Collection, workers=0,
+               include=None, exclude=()):
+    """
+        workers: Number of processes rendering the cards, 0 or 1 to render them on this thread
+        include, exclude: names of the deck folders synced, all of them when include is None
+    """
+    decks = []
     for folder in path_folder.iterdir():
-        if folder.is_dir() and not folder.name.startswith("."):
+        if folder.is_dir() and not folder.name.startswith(".") and is_deck_synced(folder.name, include, exclude):
             did = collection.decks.id_for_name(folder.name)
-            init_deck(collection.decks.get(did), folder, collection)
+            decks.append((collection.decks.get(did), folder))
+
+    with UndoStep(collection):
+        if workers > 1 and can_fork():
+            init_decks_in_pool(decks, collection, workers)
+            return
+
+        for deck, folder in decks:
+            init_deck(deck, folder, collection)
+
+
+def sparse_patterns(sparse) -> Union[list[str], None]:
+    """
+    Files checked out for the sparse_checkout config: the cards of every deck folder
+    for true, of the listed decks for a list, all the files for false
+    """
+    if sparse is True:
+        return ["/*/**/*.md"]
+    if sparse:
+        return [f"/{deck}/**/*.md" for deck in sparse]
+    return None
+
+
+def clone_repo(config: dict):  # pragma: no cover
+    Git().clone(
+        config["repo"],
+        str(card_folder),
+        filter=config.get("clone_filter"),
+        depth=config.get("clone_depth", 0),
+        sparse=sparse_patterns(config.get("sparse_checkout", False)),
+    )
 
 
 def init() -> None:  # pragma: no cover
@@ -118,11 +224,15 @@ def init() -> None:  # pragma: no cover
         os.remove(user_files)
         os.makedirs(user_files)
 
+    open_render_cache(render_cache_file, config.get("render_cache_mb", 64) * 1024 * 1024)
+    if config.get("blob_cache_mb", 16):
+        open_blob_cache(blob_cache_file, config.get("blob_cache_mb", 16) * 1024 * 1024)
+
     if not os.path.exists(card_folder):
-        Git().clone(config["repo"], str(card_folder))
+        clone_repo(config)
     elif not os.path.isdir(card_folder):
         os.remove(card_folder)
-        Git().clone(config["repo"], str(card_folder))
+        clone_repo(config)
 
     mw.create_backup_now()
 
@@ -132,17 +242,22 @@ def init() -> None:  # pragma: no cover
     if "Ankill" not in [n.name for n in mw.col.models.all_names_and_ids()]:
         mw.col.models.save(create_model(mw.col))
 
-    create_decks(card_folder, deck_name, mw.col)
-    fill_decks(card_folder, deck_name, mw.col)
+    include = config.get("decks")
+    exclude = config.get("exclude_decks", [])
+    create_decks(card_folder, deck_name, mw.col, include, exclude)
+    fill_decks(card_folder, deck_name, mw.col, config.get("workers", 0), include, exclude)
 
     op = QueryOp(
         parent=mw,
         op=update_repo,
-        success=refresh_card,
+        success=sync_cards,
     )
 
     op.with_progress(label="Update git repo").run_in_background()
     mw.deckBrowser.refresh()
 
 
-gui_hooks.profile_did_open.append(init)
+if gui_hooks is not None:
+    gui_hooks.profile_did_open.append(init)
+    gui_hooks.profile_will_close.append(close_render_cache)
+    gui_hooks.profile_will_close.append(close_blob_cache)
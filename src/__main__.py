@@ -0,0 +1,52 @@
+"""
+Sync a collection with a card repository outside of Anki, or print the changes a sync would make.
+
+    python -m src [--repo path] [--collection path] [--dry-run] rev_from rev_to
+
+Without a collection, every deck folder of the repository is taken as a deck and the plan is only printed.
+"""
+
+import argparse
+import os
+
+from anki.collection import Collection
+from .diff import Diff, apply_plan
+from .git import deck_pathspecs
+from .utils import create_model
+
+
+def main(argv: [str] = None):
+    parser = argparse.ArgumentParser(prog="python -m src", description=__doc__.strip().split("\n")[0])
+    parser.add_argument("rev_from")
+    parser.add_argument("rev_to")
+    parser.add_argument("--repo", default=".", help="card repository, the current directory by default")
+    parser.add_argument("--collection", help="path of the .anki2 collection to update")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan without writing it")
+    parser.add_argument("--source", choices=("patch", "raw"), default="patch")
+    parser.add_argument("--strategy", choices=("hunks", "cards"), default="cards")
+    parser.add_argument("--deck", action="append", dest="decks", help="deck folder to sync, all of them by default")
+    parser.add_argument("--exclude-deck", action="append", dest="exclude_decks", default=[])
+    parser.add_argument("--workers", type=int, default=0, help="processes parsing and rendering the files")
+    args = parser.parse_args(argv)
+
+    collection = None if args.collection is None else Collection(os.path.realpath(args.collection))
+    os.chdir(args.repo)
+    try:
+        diff = Diff(
+            args.rev_from, args.rev_to, collection, args.source,
+            deck_pathspecs(args.decks, args.exclude_decks), args.strategy, args.workers,
+        )
+        decks = None if collection is None else [deck.name for deck in collection.decks.all_names_and_ids()]
+        plan = diff.plan(decks)
+        print(plan)
+        if collection is not None and not args.dry_run:
+            if collection.models.by_name("Ankill") is None:
+                collection.models.save(create_model(collection))
+            print(apply_plan(plan, collection))
+    finally:
+        if collection is not None:
+            collection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+from typing import Union
+
+from .sqlite_lru import SqliteLru
+
+
+class BlobCache:
+    """
+        Cache of the content of git objects by oid, which never changes.
+        Least recently used blobs are kept in memory up to max_bytes,
+        and on disk up to disk_max_bytes when a path is given.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, path: Union[str, None] = None,
+                 disk_max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.blobs = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.disk = None
+        self.disk_max_bytes = disk_max_bytes
+        if path is not None:
+            self.disk = SqliteLru(path, "blob", ["oid text"], ["content blob"], disk_max_bytes)
+
+    def get(self, oid: str) -> Union[bytes, None]:
+        with self.lock:
+            content = self.blobs.get(oid)
+            if content is not None:
+                self.blobs.move_to_end(oid)
+                return content
+        if self.disk is None:
+            return None
+
+        row = self.disk.read((oid,))
+        if row is None:
+            return None
+        with self.lock:
+            self._keep(oid, row[0])
+        return row[0]
+
+    def put(self, oid: str, content: bytes) -> None:
+        with self.lock:
+            if oid in self.blobs:
+                return
+            self._keep(oid, content)
+        if self.disk is None or len(content) > self.disk_max_bytes:
+            return
+        self.disk.write((oid,), (content,), len(content), replace=False)
+
+    def _keep(self, oid: str, content: bytes) -> None:
+        if len(content) > self.max_bytes:
+            return
+        self.blobs[oid] = content
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            (_, evicted) = self.blobs.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self) -> int:
+        if self.disk is None:
+            with self.lock:
+                return len(self.blobs)
+        return len(self.disk)
+
+    def flush(self) -> None:
+        if self.disk is not None:
+            self.disk.flush()
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
@@ -1,187 +1,695 @@
-from anki.decks import DeckDict
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from unidiff import PatchedFile, PatchSet
-from .git import Git
-from .gen_md import CardGenerator, DeckGenerator
-from .utils import get_stripped_lines, is_extends, add_note_to_deck
-from aqt import mw
+from .git import Git, RawChange, deck_pathspecs
+from .plan import CardSource, ChangePlan, Note, PlanBuilder
+from .gen_md import CardGenerator, MdFile, can_fork, worker_pool, take_renders, cache_renders
+from .utils import (
+    Card, UndoStep, merge_undo, get_stripped_lines, is_card_start, add_note_to_deck, get_note_hashes,
+    update_note_fields, move_notes_to_deck,
+)
 import anki
-from typing import Union
-import hashlib
+from typing import Callable, Iterable, Iterator, NamedTuple, Union
+
+
+class CardIndex:
+    """
+    Cards of a source by line: the first lines of the cards are kept sorted
+    and a line is looked up with bisect, the source is split and parsed once.
+    Cards are those of MdFile, so their hashes are the ones of the deck.
+    """
+
+    def __init__(self, source: str, md_file: MdFile = None):
+        self.file = MdFile(source) if md_file is None else md_file
+        self.lines = source.splitlines()
+        self.starts = self.file.starts
+
+    def find(self, nth: int) -> Union[int, None]:
+        """
+        Position in file.cards of the card that contains nth line
+        """
+        if len(self.lines) < nth:
+            return None
+        n = bisect.bisect_right(self.starts, nth) - 1
+        return None if n < 0 else n
+
+    def card(self, nth: int) -> Union[Card, None]:
+        n = self.find(nth)
+        return None if n is None else self.file.cards[n]
+
+    def note_of_scope(self, nth: int) -> Union[str, None]:
+        n = self.find(nth)
+        # Lines before the first card are no note here
+        if n is None or not is_card_start(self.lines[self.starts[n]]):
+            return None
+        end = self.starts[n + 1] if n + 1 < len(self.starts) else len(self.lines)
+        lines = self.lines[self.starts[n]:end]
+        while len(lines) != 0 and lines[-1].strip() == "":
+            lines.pop()
+        return "\n".join(lines)
 
 
 def get_note_of_scope(source: str, nth) -> Union[str, None]:
     """
     Return the note that contains nth line
     """
-    lines = source.splitlines()
-    if len(lines) < nth:
-        return None
+    return CardIndex(source).note_of_scope(nth)
 
-    start_line = None
-    for n, i in enumerate(lines[0: nth + 1]):
-        if i.startswith("##"):
-            start_line = n
 
-    if start_line is None:
-        return None
+def create_note(s: str, deckid, model, collection):
+    create_card_note(Card.from_source(s), deckid, model, collection)
+
 
-    end_line = None
-    for n, i in enumerate(lines[nth + 1:]):
-        if i.startswith("##"):
-            end_line = n
+def create_card_note(card: Card, deckid, model, collection):
+    note = CardGenerator(extend=card.extend).gen_card(card)
+    add_note_to_deck([note], model["id"], deckid, collection)
 
-    if end_line is None:
-        return "\n".join(lines[start_line:])
 
-    return "\n".join(lines[start_line: (start_line + end_line)])
+class BatchReport(NamedTuple):
+    """
+    What a NoteBatch wrote, once the changes of the whole sync were netted out
+    """
+    added: int
+    updated: int
+    deleted: int
+    # Deleted from a file and added by another to the same deck: left untouched
+    kept: int
+    # Deleted from a deck and added to another: their cards were moved
+    moved: int
+    # Updates of a note replaced by a later one, or dropped as the note is deleted
+    coalesced: int
+
+    def __str__(self):
+        return (
+            f"{self.added} added, {self.updated} updated, {self.deleted} deleted, "
+            f"{self.moved} moved, {self.kept} kept, {self.coalesced} coalesced"
+        )
+
+
+def render_note(note: Union[Note, CardSource]) -> Note:
+    """
+    Note of an addition, rendering the card of an added file
+    """
+    if isinstance(note, CardSource):
+        return CardGenerator(extend=note.extend).gen_card(Card(note.source, note.hash, note.extend))
+    return note
 
 
-def create_note(s: str, deckid, model, collection):
-    note = collection.new_note(model["id"])
+class NoteBatch:
+    """
+    Note additions, updates and deletions collected while applying a plan,
+    netted out and written to the collection with one call each by write().
+    A card deleted and added again keeps its note, in place or moved to its new deck.
+    """
 
-    recto, verso, hash = CardGenerator(extend=is_extends(s)).gen_note_with_hash(s)
+    def __init__(self, collection: anki.collection.Collection):
+        self.collection = collection
+        # Note id -> (recto, verso, hash)
+        self.updates = {}
+        # Note id -> (hash, deck id) of the card deleted, when known
+        self.deletes = {}
+        # Deck id -> hash -> (recto, verso, hash) or CardSource
+        self.adds = {}
+        # Deck id -> hash to note id index updated with the notes added
+        self.indexes = {}
+        self.coalesced = 0
+
+    def update(self, nid: int, note: (str, str, str)) -> None:
+        if nid in self.updates:
+            self.coalesced += 1
+        self.updates[nid] = note
+
+    def delete(self, nid: int, card_hash: str = None, did: int = None) -> None:
+        self.deletes[nid] = (card_hash, did)
+
+    def add(self, did: int, note: Union[Note, CardSource], hash_notes: dict[str, int] = None) -> None:
+        """
+        note: rendered when written, if its card is not in the deck by then
+        hash_notes: Hash to note id index of the deck, given the id of the note when written
+        """
+        self.adds.setdefault(did, {})[note[2]] = note
+        if hash_notes is not None:
+            self.indexes[did] = hash_notes
+
+    def plan(self) -> (dict[int, int], dict[int, int]):
+        """
+        Notes deleted whose card is added again: note id -> deck id of the addition,
+        split into those kept in their deck and those moved
+        """
+        deleted = {}
+        for nid, (card_hash, did) in self.deletes.items():
+            if card_hash is not None:
+                deleted.setdefault(card_hash, {})[did] = nid
+        kept = {}
+        kept_at = set()
+        moved = {}
+        # Cards added back to their deck first, so that a move does not take their note
+        for did, notes in self.adds.items():
+            for card_hash in notes:
+                nid = deleted.get(card_hash, {}).pop(did, None)
+                if nid is not None:
+                    kept[nid] = did
+                    kept_at.add((card_hash, did))
+        for did, notes in self.adds.items():
+            index = self.indexes.get(did, {})
+            for card_hash in notes:
+                from_decks = deleted.get(card_hash)
+                if from_decks and card_hash not in index and (card_hash, did) not in kept_at:
+                    moved[from_decks.popitem()[1]] = did
+        return (kept, moved)
+
+    def write(self) -> BatchReport:
+        (kept, moved) = self.plan()
+        revived = {**kept, **moved}
+        deletes = [nid for nid in self.deletes if nid not in revived]
+        self.coalesced += len([nid for nid in self.updates if nid in self.deletes and nid not in revived])
+
+        if len(deletes) != 0:
+            self.collection.remove_notes(deletes)
+            merge_undo(self.collection)
+
+        for did in set(moved.values()):
+            move_notes_to_deck([nid for nid, to in moved.items() if to == did], did, self.collection)
+
+        updates = {nid: note for nid, note in self.updates.items() if nid not in self.deletes or nid in revived}
+        update_note_fields(updates, self.collection)
+
+        for nid, did in revived.items():
+            self.indexes.setdefault(did, {})[self.deletes[nid][0]] = nid
 
-    note.fields[0] = recto
-    note.fields[1] = verso
-    note.fields[2] = hash
-    collection.add_note(note, deckid)
+        model = self.collection.models.by_name("Ankill")
+        added = 0
+        for did, notes in self.adds.items():
+            index = self.indexes.setdefault(did, {})
+            new_notes = [render_note(note) for card_hash, note in notes.items() if card_hash not in index]
+            note_ids = add_note_to_deck(new_notes, model["id"], did, self.collection)
+            index.update(zip([card_hash for (_, _, card_hash) in new_notes], note_ids))
+            added += len(new_notes)
+
+        report = BatchReport(added, len(updates), len(deletes), len(kept), len(moved), self.coalesced)
+        self.updates = {}
+        self.deletes = {}
+        self.adds = {}
+        self.indexes = {}
+        self.coalesced = 0
+        return report
 
 
 class DeleteFile:
-    def __init__(self, from_source: str, deck: DeckDict, collection: anki.collection.Collection):
+    def __init__(self, from_source: str, deck: str, plan: PlanBuilder):
+        """
+        deck: Name of the deck of the file
+        plan: Changes of the sync, given the deletion of every card of the file
+        """
         self.from_source = from_source
-        self.deckid = deck["id"]
-        self.collection = collection
-
-    def _delete_one(self, source: str):
-        stripped_lines = get_stripped_lines(source)
-        hash = hashlib.sha512(bytes("\n".join(stripped_lines), "utf-8")).hexdigest()
-        q = f"hash:{hash} did:{self.deckid} "
-        self.collection.remove_notes(self.collection.find_notes(q))
+        self.deck = deck
+        self.plan = plan
 
     def delete(self):
-        for i in self.from_source.split("##"):
-            self._delete_one("##" + i)
+        for card in MdFile(self.from_source).cards:
+            self.plan.delete(self.deck, card.hash)
 
 
 class ModifiedFile:
-    def __init__(
-        self, from_source: str, to_source: str, diff: PatchedFile, deck: DeckDict,
-        collection: anki.collection.Collection
-    ):
+    def __init__(self, from_source: str, to_source: str, diff: PatchedFile, deck: str, plan: PlanBuilder):
+        """
+        deck: Name of the deck of the file
+        plan: Changes of the sync, given the cards touched by the hunks
+        """
         self.from_source = from_source
         self.to_source = to_source
         self.diff = diff
-        self.deckid = deck["id"]
-        self.collection = collection
-
-    def create(self, to_note):
-        model = self.collection.models.by_name("Ankill")
-        create_note(to_note, self.deckid, model, self.collection)
-
-    def _update(self, from_note, to_note):
-        stripped_lines = get_stripped_lines(from_note)
-        hash = hashlib.sha512(bytes("\n".join(stripped_lines), "utf-8")).hexdigest()
-        q = f"hash:{hash} did:{self.deckid}"
-        notes = self.collection.find_notes(q)
-
-        if len(notes) == 0:
-            return
-
-        unote = self.collection.get_note(notes[0])
-        (recto, verso, hash) = CardGenerator(
-            extend=is_extends(to_note)
-        ).gen_note_with_hash(to_note)
-        unote.fields[0] = recto
-        unote.fields[1] = verso
-        unote.fields[2] = hash
-        self.collection.update_note(unote)
+        self.deck = deck
+        self.plan = plan
+        self.from_index = CardIndex(from_source)
+        self.to_index = CardIndex(to_source)
+        # Hashes of the old cards updated, and the old cards to delete once update() read every hunk
+        self.updated = set()
+        self.deleted = {}
+
+    def create(self, to_card: int):
+        """
+        to_card: position of the card in the new source
+        """
+        self.plan.add(self.deck, self.to_index.file.gen_card(to_card))
+
+    def _update(self, from_card: Card, to_card: int):
+        self.updated.add(from_card.hash)
+        self.deleted.pop(from_card.hash, None)
+        self.plan.update(self.deck, from_card.hash, self.to_index.file.gen_card(to_card))
+
+    def _delete(self, from_card: Card):
+        # Planned by update() unless a later group updates the card, as when its ## line is edited
+        self.deleted[from_card.hash] = from_card
 
     def _update_one(self, hunk):
-        from_note = get_note_of_scope(self.from_source, hunk.source_start)
-        to_note = get_note_of_scope(self.to_source, hunk.target_start)
-        print("DD", from_note)
-        if from_note is None:
-            self.create(to_note)
+        from_card = self.from_index.card(hunk.source_start - 1)
+        to_card = self.to_index.find(hunk.target_start - 1)
+        if to_card is None:
+            return
+        if from_card is None:
+            self.create(to_card)
         else:
-            self._update(from_note, to_note)
+            self._update(from_card, to_card)
 
     def __is_all_deleted_line(self, lines: [any]):
         return all([i.is_removed for i in lines])
 
     def __is_all_added_line(self, lines: [any]):
-        return all([i.is_removed for i in lines])
+        return all([i.is_added for i in lines])
 
-    def create_or_update_note(self, lines: [any], start_line: int, model) -> None:
+    def create_or_update_note(self, lines: [any]) -> None:
+        """
+        lines: Lines of a hunk from a ## line to the next one
+        """
         # FIXME: Remove stripped line and strip on value. Side-effect ?
         str_lines = get_stripped_lines("\n".join([f.value for f in lines]))
-        print("EEE", str_lines)
         if len(str_lines) == 0:
             return
 
+        # First line of the group in each version, 0-based like the lines of the card indexes
+        from_line = next((line.source_line_no - 1 for line in lines if line.source_line_no is not None), None)
+        to_line = next((line.target_line_no - 1 for line in lines if line.target_line_no is not None), None)
+
         if self.__is_all_deleted_line(lines):
-            note = get_note_of_scope(self.from_source, start_line)
-            DeleteFile(note, self.collection.decks.get(self.deckid)["name"]).delete()
+            card = self.from_index.card(from_line)
+            if card is not None:
+                self._delete(card)
             return
 
         if self.__is_all_added_line(lines):
-            unote = get_note_of_scope(self.to_source, start_line)
-
-            create_note(unote, self.deckid, model, self.collection)
+            ucard = self.to_index.find(to_line)
+            if ucard is not None:
+                self.create(ucard)
             return
 
-        note = get_note_of_scope(self.from_source, start_line)
-        unote = get_note_of_scope(self.to_source, start_line)
-        self._update(note, unote)
-        return
+        if to_line is None:
+            return
+        card = None if from_line is None else self.from_index.card(from_line)
+        if lines[0].is_added and card is not None and card.hash not in self.deleted:
+            # A new ## line: the old lines after it were the end of the card before it
+            card = None
+        ucard = self.to_index.find(to_line)
+        if ucard is None:
+            return
+        if card is None:
+            self.create(ucard)
+        elif card.hash != self.to_index.file.cards[ucard].hash:
+            self._update(card, ucard)
 
     def update(self):
-        model = self.collection.models.by_name("Ankill")
+        self.updated = set()
+        self.deleted = {}
         for hunk in self.diff:
-            start_line = hunk.target_start
             buf = []
             for line in hunk:
-                if line.value.startswith("##"):
-                    if len(buf) != 0:
-                        self.create_or_update_note(buf, start_line, model)
-                        start_line += len(buf)
-                        buf = []
+                if is_card_start(line.value) and len(buf) != 0:
+                    self.create_or_update_note(buf)
+                    buf = []
                 buf.append(line)
 
             if len(buf) != 0:
-                self.create_or_update_note(buf, start_line, model)
+                self.create_or_update_note(buf)
+
+        for card_hash in self.deleted:
+            if card_hash not in self.updated:
+                self.plan.delete(self.deck, card_hash)
+
+
+class CardSetFile:
+    """
+    Update the notes of a modified file from the cards of its two versions instead of its hunks:
+    cards whose hash disappeared are updated into the new cards with the same heading,
+    then into the remaining new cards in order, and deleted when none is left.
+    The new cards left over are created. Each card is written at most once.
+    """
+
+    def __init__(self, from_source: str, to_source: str, deck: str, plan: PlanBuilder):
+        """
+        deck: Name of the deck of the file
+        plan: Changes of the sync, given those of the cards
+        """
+        self.from_file = MdFile(from_source)
+        self.to_file = MdFile(to_source)
+        self.deck = deck
+        self.plan = plan
+
+    @staticmethod
+    def heading(card: Card) -> str:
+        return card.source.split("\n", 1)[0]
+
+    def changes(self) -> ([Card], [int], [tuple[Card, int]]):
+        """
+        Cards of the old version to delete, positions of the cards of the new version to create,
+        and pairs of both to update
+        """
+        to_hashes = {card.hash for card in self.to_file.cards}
+        from_hashes = {card.hash for card in self.from_file.cards}
+        removed = [card for card in self.from_file.cards if card.hash not in to_hashes]
+        added = [n for (n, card) in enumerate(self.to_file.cards) if card.hash not in from_hashes]
+
+        by_heading = {}
+        for card in removed:
+            by_heading.setdefault(self.heading(card), []).append(card)
+
+        updated = []
+        unpaired = []
+        for n in added:
+            same_heading = by_heading.get(self.heading(self.to_file.cards[n]))
+            if same_heading:
+                updated.append((same_heading.pop(0), n))
+            else:
+                unpaired.append(n)
+
+        paired = {id(card) for (card, _) in updated}
+        removed = [card for card in removed if id(card) not in paired]
+        updated += zip(removed, unpaired)
+        return (removed[len(unpaired):], unpaired[len(removed):], updated)
+
+    def update(self):
+        (deleted, created, updated) = self.changes()
+        for card in deleted:
+            self.plan.delete(self.deck, card.hash)
+        for (from_card, n) in updated:
+            self.plan.update(self.deck, from_card.hash, self.to_file.gen_card(n))
+        for n in created:
+            self.plan.add(self.deck, self.to_file.gen_card(n))
+
+
+def apply_plan(plan: ChangePlan, collection: anki.collection.Collection) -> BatchReport:
+    """
+    Write a plan to the collection as one undo step, resolved against the notes of its decks:
+    an update of a card without note creates it, one into a card already in the deck deletes the old note,
+    and the cards already in the deck are neither rendered nor added again.
+    """
+    decks = {}
+
+    def deck_index(name: str) -> Union[tuple[int, dict[str, int]], None]:
+        if name not in decks:
+            deck = collection.decks.by_name(name)
+            if deck is None:
+                print(f"WARN: Deck({name}) is none")
+                decks[name] = None
+            else:
+                decks[name] = (deck["id"], get_note_hashes(deck["id"], collection))
+        return decks[name]
+
+    batch = NoteBatch(collection)
+    with UndoStep(collection):
+        moved = {}
+        for (from_deck, to_deck, card_hash) in plan.moves:
+            (source, target) = (deck_index(from_deck), deck_index(to_deck))
+            if source is None or target is None:
+                continue
+            nid = source[1].pop(card_hash, None)
+            if nid is not None:
+                moved.setdefault(target[0], []).append(nid)
+                target[1][card_hash] = nid
+        for did, nids in moved.items():
+            move_notes_to_deck(nids, did, collection)
+
+        for (name, changes) in plan.decks:
+            index = deck_index(name)
+            if index is None:
+                continue
+            (did, hash_notes) = index
+            for card_hash in changes.deletes:
+                nid = hash_notes.pop(card_hash, None)
+                if nid is not None:
+                    batch.delete(nid, card_hash, did)
+
+            # Every old card is taken out of the index first, an update may replace the card of another one
+            updates = [(hash_notes.pop(card_hash, None), card_hash, note) for (card_hash, note) in changes.updates]
+            for (nid, card_hash, note) in updates:
+                if nid is None:
+                    batch.add(did, note, hash_notes)
+                elif note[2] in hash_notes:
+                    # Already a note of the deck, from another file
+                    batch.delete(nid, card_hash, did)
+                else:
+                    batch.update(nid, note)
+                    hash_notes[note[2]] = nid
+
+            for note in changes.adds:
+                batch.add(did, note, hash_notes)
+        report = batch.write()
+    return report._replace(moved=report.moved + sum(len(nids) for nids in moved.values()))
+
+
+# Number of files of a diff whose sources are read together
+DIFF_BATCH = 64
+
+
+def source_path(patched: PatchedFile) -> str:
+    """
+    Path of the file before the patch, which differs from patched.path for renames
+    """
+    path = patched.source_file
+    if path.startswith("a/"):
+        path = path[2:]
+    return path
+
+
+def iter_patched_files(lines: Iterator[bytes]) -> Iterator[PatchedFile]:
+    """
+    Files of a git diff, each parsed once its lines are read
+    """
+    chunk = []
+    for line in lines:
+        if line.startswith(b"diff --git ") and chunk:
+            yield from PatchSet(chunk, encoding="utf-8")
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield from PatchSet(chunk, encoding="utf-8")
+
+
+def read_ahead(batches: Iterable, read: Callable) -> Iterator:
+    """
+    read() of each batch, the next batch being read on a thread while the caller handles the current one
+    """
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        pending = None
+        for batch in batches:
+            future = reader.submit(read, batch)
+            if pending is not None:
+                yield pending.result()
+            pending = future
+        if pending is not None:
+            yield pending.result()
+
+
+class FileChange(NamedTuple):
+    """
+        A card file changed between the revisions of a diff.
+        from_deck, from_source: deck and content of the file before, None when it is added
+        to_deck, to_source: deck and content of the file after, None when it is removed
+        patch: hunks of the file, used by the "hunks" strategy
+    """
+    from_deck: Union[str, None]
+    to_deck: Union[str, None]
+    from_source: Union[str, None]
+    to_source: Union[str, None]
+    patch: Union[PatchedFile, None] = None
+
+
+def plan_file(changes: PlanBuilder, file: FileChange, strategy: str) -> None:
+    """
+    strategy: "hunks" updates the cards touched by the hunks of a modified file (ModifiedFile),
+              "cards" compares the cards of its two versions (CardSetFile)
+    """
+    if file.to_deck is None:
+        DeleteFile(file.from_source, file.from_deck, changes).delete()
+        return
+    if file.from_deck is None:
+        # Every card is planned, rendered by apply_plan only when it is not already in the deck
+        for card in MdFile(file.to_source).cards:
+            changes.add(file.to_deck, CardSource(card.source, card.extend, card.hash))
+        return
+
+    if file.from_deck != file.to_deck:
+        # The notes of the file go to the other deck, without being recreated
+        for card in MdFile(file.from_source).cards:
+            changes.move(file.from_deck, file.to_deck, card.hash)
+    if file.from_source == file.to_source:
+        return
+    if strategy == "cards":
+        CardSetFile(file.from_source, file.to_source, file.to_deck, changes).update()
+    elif file.patch is not None:
+        ModifiedFile(file.from_source, file.to_source, file.patch, file.to_deck, changes).update()
+
+
+def plan_files(files: [FileChange], strategy: str) -> (PlanBuilder, [(str, bool, str, str)]):
+    """
+    Pool task: plan the changes of the cards of the files, in order, with the renders to cache
+    """
+    changes = PlanBuilder()
+    for file in files:
+        plan_file(changes, file, strategy)
+    return (changes, take_renders())
 
 
 class Diff:
-    def __init__(self, rev_from: str, rev_to: str, collection: anki.collection.Collection):
+    def __init__(self, rev_from: str, rev_to: str, collection: anki.collection.Collection = None,
+                 source: str = "patch", pathspecs: Union[list[str], None] = None, strategy: str = "cards",
+                 workers: int = 0):
+        """
+        collection: written by update_deck_and_notes(), plan() reads the repository alone
+        source: "patch" reads the changed files from the unified diff of the revisions,
+                "raw" from `git diff --raw` and fetches the files by blob id
+        pathspecs: files git diffs, the .md files of every deck folder by default
+        strategy: "hunks" updates the cards touched by the hunks of a modified file (ModifiedFile),
+                  "cards" compares the cards of its two versions (CardSetFile)
+        workers: Number of processes parsing and rendering the files, 0 or 1 to do it on this thread,
+                 as where processes cannot be forked
+        """
         self.rev_from = rev_from
         self.rev_to = rev_to
         self.collection = collection
+        self.source = source
+        self.strategy = strategy
+        self.workers = workers
+        self.pathspecs = deck_pathspecs() if pathspecs is None else pathspecs
+        self.git = Git()
+        # Lower case names of the existing decks, None when every deck folder is one
+        self.decks = None
+        self.changes = PlanBuilder()
+        self.executor = None
+        # Plans of the files sent to the pool, in the order of the diff
+        self.pending = []
+
+    def get_deck(self, path: str) -> Union[str, None]:
+        """
+        Name of the deck of the file, None when the file is not a card file of a deck
+        """
+        deck_name = path.split("/")[0]
+        if self.decks is not None and deck_name.lower() not in self.decks:
+            print(f"WARN: Deck({deck_name}) is none")
+            return None
+
+        if not path.endswith(".md"):
+            return None
+
+        return deck_name
+
+    def plan(self, decks: Union[list[str], None] = None) -> ChangePlan:
+        """
+        Changes of the cards between the revisions, read from the repository without the collection.
+        With workers, the files are parsed and rendered on a pool while git reads the next ones.
+        decks: names of the decks the files can belong to, every deck folder when None
+        """
+        self.decks = None if decks is None else {name.lower() for name in decks}
+        self.changes = PlanBuilder()
+        self.pending = []
+        pool = worker_pool(self.workers) if self.workers > 1 and can_fork() else nullcontext()
+        with self.git, pool as self.executor:
+            if self.source == "raw":
+                self.update_from_raw()
+            else:
+                self.update_from_patch()
+            for future in self.pending:
+                (changes, renders) = future.result()
+                cache_renders(renders)
+                self.changes.merge(changes)
+        self.executor = None
+        self.pending = []
+        return self.changes.build(self.rev_from, self.rev_to)
+
+    def update_deck_and_notes(self) -> BatchReport:
+        """
+        Plan the sync, then write it to the collection as one undo step from this thread
+        """
+        plan = self.plan([deck.name for deck in self.collection.decks.all_names_and_ids()])
+        return apply_plan(plan, self.collection)
+
+    def plan_files(self, files: [FileChange]):
+        if self.executor is None:
+            for file in files:
+                plan_file(self.changes, file, self.strategy)
+            return
 
-    def update_deck_and_notes(self):
-        for i in PatchSet(Git().diff(self.rev_from, self.rev_to)):
-            # print(i)
-            deck_name = i.path.split("/")[0]
-            deck = self.collection.decks.by_name(deck_name)
-            if deck is None:
-                print(f"WARN: Deck({deck_name}) is none")
+        # Contiguous chunks, merged back in order: a later file overrides the changes of an earlier one
+        size = -(-len(files) // self.workers)
+        for n in range(0, len(files), size):
+            self.pending.append(self.executor.submit(plan_files, files[n:n + size], self.strategy))
+
+    def update_from_patch(self):
+        for changes in read_ahead(self.patched_batches(), self.read_patched_files):
+            self.plan_files(changes)
+
+    def patched_batches(self) -> Iterator[list[tuple[PatchedFile, str, str]]]:
+        files = []
+        for i in iter_patched_files(self.git.diff_lines(self.rev_from, self.rev_to, self.pathspecs)):
+            deck = self.get_deck(i.path)
+            from_deck = self.get_deck(source_path(i)) if i.is_rename else deck
+            if deck is None and from_deck is None:
                 continue
-            
-            if not i.path.endswith(".md"):
-                continue
-
-            if i.is_added_file and not i.is_rename:
-                notes_source = Git().show(self.rev_to, i.path)
-                model = self.collection.models.by_name("Ankill")
-                notes = DeckGenerator(deck["id"], self.collection).gen_decks(notes_source)
-                add_note_to_deck(notes, model["id"], deck["id"], self.collection)
-
-            if i.is_removed_file and not i.is_rename:
-                from_source = Git().show(self.rev_from, i.path)
-                DeleteFile(from_source, deck, self.collection).delete()
-
-            if i.is_modified_file:
-                # print("THIS IS AN EDITED FILELLLLL")
-                from_source = Git().show(self.rev_from, i.path)
-                to_source = Git().show(self.rev_to, i.path)
-                ModifiedFile(from_source, to_source, i, deck, self.collection).update()
+            files.append((i, from_deck, deck))
+            if len(files) == DIFF_BATCH:
+                yield files
+                files = []
+        if files:
+            yield files
+
+    def read_patched_files(self, files: [tuple[PatchedFile, str, str]]) -> [FileChange]:
+        # Read every version needed at once, git is only run for what the object store misses
+        wanted = []
+        for (i, _, _) in files:
+            if not i.is_added_file:
+                wanted.append(f"{self.rev_from}:{source_path(i)}")
+            if not i.is_removed_file:
+                wanted.append(f"{self.rev_to}:{i.path}")
+        sources = self.git.show_many(wanted)
+
+        changes = []
+        for (i, from_deck, deck) in files:
+            from_source = None if i.is_added_file else sources[f"{self.rev_from}:{source_path(i)}"]
+            to_source = None if i.is_removed_file else sources[f"{self.rev_to}:{i.path}"]
+            if i.is_added_file:
+                from_deck = None
+            if i.is_removed_file:
+                deck = None
+            # The cards strategy has no use of the hunks, they are not pickled for the workers
+            patch = None if self.strategy == "cards" else i
+            changes.append(FileChange(from_deck, deck, from_source, to_source, patch))
+        return changes
+
+    def update_from_raw(self):
+        files = []
+        for change in self.git.diff_raw(self.rev_from, self.rev_to, self.pathspecs):
+            deck = self.get_deck(change.new_path)
+            from_deck = self.get_deck(change.old_path) if change.status == "R" else deck
+            if deck is not None or from_deck is not None:
+                files.append((change, from_deck, deck))
+
+        batches = [files[n:n + DIFF_BATCH] for n in range(0, len(files), DIFF_BATCH)]
+        for changes in read_ahead(batches, self.read_raw_files):
+            self.plan_files(changes)
+
+    def read_raw_files(self, files: [tuple[RawChange, str, str]]) -> [FileChange]:
+        sources = self.git.show_many(
+            [change.old_oid for (change, _, _) in files if change.status not in ("A", "C")]
+            + [change.new_oid for (change, _, _) in files if change.status != "D"]
+        )
+        # The cards strategy compares the cards of the files, it has no use of their hunks
+        patches = {} if self.strategy == "cards" else self.git.diff_blobs_many(
+            [(change.old_oid, change.new_oid) for (change, _, _) in files
+             if change.status in ("M", "T", "R") and change.old_oid != change.new_oid]
+        )
+
+        def patch_of(change: RawChange) -> Union[PatchedFile, None]:
+            patch = PatchSet(patches.get((change.old_oid, change.new_oid), ""))
+            return patch[0] if len(patch) != 0 else None
+
+        changes = []
+        for (change, from_deck, deck) in files:
+            if change.status in ("A", "C"):
+                changes.append(FileChange(None, deck, None, sources[change.new_oid]))
+            elif change.status == "D":
+                changes.append(FileChange(deck, None, sources[change.old_oid], None))
+            elif change.status == "R" or (change.status in ("M", "T") and change.old_oid != change.new_oid):
+                changes.append(
+                    FileChange(from_deck, deck, sources[change.old_oid], sources[change.new_oid], patch_of(change))
+                )
+        return changes
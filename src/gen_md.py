@@ -1,23 +1,95 @@
 import anki
-import hashlib
+import bisect
+import multiprocessing
+import threading
+from typing import Union
+from concurrent.futures import ProcessPoolExecutor
 import marko
-from aqt import mw
-from .marko_ext import EmbedLatex, EmbedLatexMixin
+from .marko_ext import EmbedLatex, EmbedLatexMixin, CardHeading
 from marko.ext.gfm import make_extension
-from .utils import get_stripped_lines
+from marko.source import Source
+from .utils import Card, get_stripped_lines, get_note_hashes, hash_source, is_card_start
+from .render_cache import RenderCache, renderer_version
 
 EmbedLatexExtension = marko.MarkoExtension(renderer_mixins=[EmbedLatexMixin],
                                            elements=[EmbedLatex])
+CardHeadingExtension = marko.MarkoExtension(elements=[CardHeading])
+
+# marko.Markdown is not thread-safe, so each thread keeps its own engine
+_engines = threading.local()
+_render_cache = None
+_parent_render_cache = None
+# Renders of a pool worker, sent back with the results of its tasks to be cached by the parent
+_worker_renders = None
+
+
+def extensions() -> [marko.MarkoExtension]:
+    return [EmbedLatexExtension, CardHeadingExtension, make_extension()]
+
+
+def cached_render(card_hash: str, extend: bool, render) -> (str, str):
+    """
+    Return the cached (recto, verso) of the card or call render() and cache its result
+    """
+    if _render_cache is None:
+        (recto, verso) = render()
+        if _worker_renders is not None:
+            _worker_renders.append((card_hash, extend, recto, verso))
+        return (recto, verso)
+
+    cached = _render_cache.get(card_hash, extend)
+    if cached is not None:
+        return cached
+
+    (recto, verso) = render()
+    _render_cache.put(card_hash, extend, recto, verso)
+    return (recto, verso)
+
+
+def open_render_cache(path, max_bytes: int) -> RenderCache:
+    """
+    Use an on-disk cache of rendered cards for every CardGenerator
+    """
+    global _render_cache
+    _render_cache = RenderCache(path, renderer_version(*extensions()), max_bytes)
+    return _render_cache
+
+
+def close_render_cache() -> None:
+    global _render_cache
+    if _render_cache is not None:
+        _render_cache.close()
+        _render_cache = None
+
+
+def new_markdown() -> marko.Markdown:
+    engine = marko.Markdown()
+    engine.use(*extensions())
+    # Build the parser and renderer classes now instead of on the first convert
+    engine._setup_extensions()
+    return engine
+
+
+def get_markdown() -> marko.Markdown:
+    """
+    Return the markdown engine of the current thread, built on first use
+    """
+    engine = getattr(_engines, "markdown", None)
+    if engine is None:
+        engine = _engines.markdown = new_markdown()
+    return engine
 
 
 class CardGenerator:
-    def __init__(self, extend=False):
-        self.marko = marko.Markdown()
+    def __init__(self, extend=False, markdown: marko.Markdown = None, single_parse=True):
+        """
+        single_parse: Render recto and verso from one document instead of two conversions
+        """
+        self.marko = get_markdown() if markdown is None else markdown
         self.recto = ""
         self.verso = ""
         self.extend = extend
-        self.marko.use(EmbedLatexExtension)
-        self.marko.use(make_extension())
+        self.single_parse = single_parse
 
     def fill_buffers(self, s: str):
         if self.extend:
@@ -33,56 +105,234 @@ class CardGenerator:
 
     def gen_note(self, s: str) -> (str, str):
         self.fill_buffers(s)
+        if self.single_parse:
+            return self.render_halves(self.recto, self.verso)
         return (self.marko.convert(self.recto), self.marko.convert(self.verso))
 
+    def render_halves(self, recto: str, verso: str) -> (str, str):
+        """
+        Parse recto and verso into the same document and render both halves
+        in one renderer pass. Link reference definitions are shared by both halves.
+        The blocks of each half are still read from their own source because the
+        boundary may be inside a paragraph (the % line in extend mode).
+        """
+        parser = self.marko.parser
+        doc = parser.block_elements["Document"]()
+        halves = []
+        for text in (recto, verso):
+            source = Source(text)
+            source.parser = parser
+            with source.under_state(doc):
+                halves.append(parser.parse_source(source))
+
+        doc.children = halves[0] + halves[1]
+        with source.under_state(doc):
+            parser.parse_inline(doc, source)
+
+        with self.marko.renderer as renderer:
+            renderer.root_node = doc
+            return tuple("".join([renderer.render(element) for element in half]) for half in halves)
+
+    def gen_cached_note(self, s: str, card_hash: str) -> (str, str):
+        return cached_render(card_hash, self.extend, lambda: self.gen_note(s))
+
     def gen_note_with_hash(self, s: str):
-        hash_of_raw = hashlib.sha512(bytes(s, "utf-8")).hexdigest()
-        (recto, verso) = self.gen_note(s)
+        hash_of_raw = hash_source(s)
+        (recto, verso) = self.gen_cached_note(s, hash_of_raw)
         return (recto, verso, hash_of_raw)
 
+    def gen_card(self, card: Card) -> (str, str, str):
+        (recto, verso) = self.gen_cached_note(card.source, card.hash)
+        return (recto, verso, card.hash)
+
+
+class MdFile:
+    """
+    A markdown file split into cards at the lines starting with ##, and parsed once when a card is rendered.
+    Cards bounded by top-level headings are rendered from the blocks of the parsed file,
+    the others (a ## line inside a code block, ##Title which is no heading) on their own.
+    """
+
+    def __init__(self, s: str, markdown: marko.Markdown = None):
+        self.marko = get_markdown() if markdown is None else markdown
+        self.lines = get_stripped_lines(s)
+
+        # First line of each card, sorted
+        self.starts = [n for (n, line) in enumerate(self.lines) if is_card_start(line)]
+        # Lines before the first card are a card too, when they are not blank
+        first_line = self.starts[0] if len(self.starts) != 0 else len(self.lines)
+        if any(self.lines[0:first_line]):
+            self.starts.insert(0, 0)
+
+        self.cards = []
+        for n, start_line in enumerate(self.starts):
+            end_line = self.starts[n + 1] if n + 1 < len(self.starts) else len(self.lines)
+            self.cards.append(Card.from_lines(self.lines[start_line:end_line]))
+
+        # Parsed on the first render, the hashes of the cards do not need it
+        self._doc = None
+        self._blocks = None
+
+    @property
+    def doc(self) -> marko.block.Document:
+        if self._doc is None:
+            self.parse()
+        return self._doc
+
+    @property
+    def blocks(self) -> [Union[tuple[int, int], None]]:
+        """
+        Top-level elements of each card in the document, None when the card renders on its own
+        """
+        if self._blocks is None:
+            self.parse()
+        return self._blocks
+
+    def parse(self) -> None:
+        self._doc = self.marko.parse("\n".join(self.lines))
+
+        line_offsets = []
+        offset = 0
+        for line in self.lines:
+            line_offsets.append(offset)
+            offset += len(line) + 1
+
+        # First line -> first top-level element of each heading
+        headings = {}
+        for n, element in enumerate(self._doc.children):
+            if isinstance(element, CardHeading) and element.level >= 2:
+                headings[bisect.bisect_right(line_offsets, element.offset) - 1] = n
+
+        # A card renders differently on its own when it uses the link references of another one
+        isolated = len(self._doc.link_ref_defs) != 0
+        self._blocks = []
+        for n, start_line in enumerate(self.starts):
+            end_line = self.starts[n + 1] if n + 1 < len(self.starts) else len(self.lines)
+            end_element = headings.get(end_line) if end_line < len(self.lines) else len(self._doc.children)
+            if isolated or start_line not in headings or end_element is None:
+                self._blocks.append(None)
+            else:
+                self._blocks.append((headings[start_line], end_element))
+
+    def render_blocks(self, start: int, end: int) -> (str, str):
+        children = self.doc.children
+        with self.marko.renderer as renderer:
+            renderer.root_node = self.doc
+            recto = renderer.render(children[start])
+            verso = "".join([renderer.render(element) for element in children[start + 1:end]])
+        return (recto, verso)
+
+    def render(self, n: int) -> (str, str):
+        blocks = self.blocks[n]
+        if blocks is None:
+            # The card is not at a block boundary, render it on its own
+            return CardGenerator(markdown=self.marko).gen_note(self.cards[n].source)
+        return self.render_blocks(*blocks)
+
+    def gen_card(self, n: int) -> (str, str, str):
+        card = self.cards[n]
+        if card.extend:
+            # The recto/verso boundary is no block boundary, render the card on its own
+            return CardGenerator(extend=True, markdown=self.marko).gen_card(card)
+
+        # A cached card needs no parse of the file
+        (recto, verso) = cached_render(card.hash, False, lambda: self.render(n))
+        return (recto, verso, card.hash)
+
+
+def can_fork() -> bool:
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def worker_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Pool of rendering processes. They are forked: a spawned process would import the add-on,
+    so aqt, again. Callers render on their own thread where fork is missing (can_fork()).
+    """
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"), initializer=init_worker)
+    # The pool forks its workers on the first submit: do it now, before the caller starts threads
+    # (git readers, read-ahead) whose locks a forked child would inherit held
+    pool.submit(int).result()
+    return pool
+
+
+def init_worker() -> None:
+    """
+    Build the markdown engine of a pool worker before its first task.
+    A forked worker must not use the sqlite connection of the render cache of its parent:
+    it renders without cache and gives its renders back to the parent (take_renders()).
+    The connection is kept referenced so that it is never closed here.
+    """
+    global _render_cache, _parent_render_cache, _worker_renders
+    (_parent_render_cache, _render_cache) = (_render_cache, None)
+    _worker_renders = []
+    get_markdown()
+
+
+def take_renders() -> [(str, bool, str, str)]:
+    """
+    (hash, extend, recto, verso) of the cards rendered by this worker since the last call
+    """
+    global _worker_renders
+    (renders, _worker_renders) = (_worker_renders, [])
+    return renders
+
+
+def cache_renders(renders: [(str, bool, str, str)]) -> None:
+    """
+    Put the renders of a worker in the render cache of this process
+    """
+    if _render_cache is None:
+        return
+    for (card_hash, extend, recto, verso) in renders:
+        _render_cache.put(card_hash, extend, recto, verso)
+
+
+def gen_files(sources: [str], hash_notes: frozenset) -> ([(str, str, str)], [(str, bool, str, str)]):
+    """
+    Pool task: generate the cards of the files that are not in hash_notes, with the renders to cache
+    """
+    gen_cards = []
+    for s in sources:
+        md_file = MdFile(s)
+        for n, card in enumerate(md_file.cards):
+            if card.hash not in hash_notes:
+                gen_cards.append(md_file.gen_card(n))
+    return (gen_cards, take_renders())
+
 
 class DeckGenerator:
-    def __init__(self, did: anki.decks.DeckId, collection=None):
+    def __init__(self, did: anki.decks.DeckId, collection=None, hash_notes: dict[str, int] = None):
+        """
+        hash_notes: Hash to note id index of the deck, shared between generators of the same deck
+        """
         self.did = did
-        self.hash_notes = None
-        self.collecton = mw.col if collection is None else collection
+        self.hash_notes = hash_notes
+        if collection is None:
+            # Anki's collection, aqt is only imported by the add-on
+            from aqt import mw
+            collection = mw.col
+        self.collecton = collection
 
     def refresh_hash(self) -> None:
-        note_ids = self.collecton.find_notes(f"note:Ankill did:{self.did}")
-        notes = [self.collecton.get_note(id) for id in note_ids]
-        self.hash_notes = [note.fields[2] for note in notes]
+        self.hash_notes = get_note_hashes(self.did, self.collecton)
 
-    def is_note_in_deck(self, s: str) -> bool:
+    def is_note_in_deck(self, card: Card) -> bool:
         if self.hash_notes is None:
             self.refresh_hash()
 
         # Hash should always be an hash of the input lines of card not of the generated html
-        return hashlib.sha512(bytes(s, "utf-8")).hexdigest() in self.hash_notes
-
-    def get_md_cards(self, lines: [str]) -> [[str]]:
-        buf = []
-        card = []
-        for line in lines:
-            if line.startswith("##") and len(card) != 0:
-                buf.append(card)
-                card = []
-            card.append(line)
-        if len(card) != 0:
-            buf.append(card)
-        return buf
-
-    def is_extend_body(self, lines: [str]) -> bool:
-        return any([line.startswith("%") for line in lines])
+        return card.hash in self.hash_notes
+
+    def get_md_cards(self, lines: [str]) -> [Card]:
+        return MdFile("\n".join(lines)).cards
 
     def gen_decks(self, s: str) -> [(str, str, hash)]:
         gen_cards = []
-        cards = self.get_md_cards(get_stripped_lines(s))
-
-        for card in cards:
-            extend_body = self.is_extend_body(card)
-            lines = "\n".join(card)
-            if not self.is_note_in_deck(lines):
-                gen_card = CardGenerator(extend=extend_body).gen_note_with_hash(lines)
-                gen_cards.append(gen_card)
+        md_file = MdFile(s)
+
+        for n, card in enumerate(md_file.cards):
+            if not self.is_note_in_deck(card):
+                gen_cards.append(md_file.gen_card(n))
 
         return gen_cards
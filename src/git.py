@@ -1,23 +1,463 @@
+import asyncio
+import os
+import re
+import shutil
 import subprocess
+import threading
+import zlib
+from typing import Iterator, NamedTuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from .blob_cache import BlobCache
+from .git_objects import ObjectStore, TreeEntry, parse_tree
+
+# Number of git processes AsyncGit runs at the same time
+GIT_CONCURRENCY = 8
+OID = re.compile(r"[0-9a-f]{40}")
+
+# Blobs read by every Git, in memory only until open_blob_cache()
+_blob_cache = BlobCache()
+
+
+def open_blob_cache(path, max_bytes: int) -> BlobCache:
+    """
+    Also keep the blobs read in an on-disk cache
+    """
+    global _blob_cache
+    _blob_cache = BlobCache(path=path, disk_max_bytes=max_bytes)
+    return _blob_cache
+
+
+def close_blob_cache() -> None:
+    global _blob_cache
+    _blob_cache.close()
+    _blob_cache = BlobCache()
+
+
+class RawChange(NamedTuple):
+    """
+    A file changed between two revisions, from `git diff --raw`
+    status: A(dded), D(eleted), M(odified), R(enamed), C(opied) or T(ype changed)
+    """
+    status: str
+    old_oid: str
+    new_oid: str
+    old_path: str
+    new_path: str
+
+
+def deck_pathspecs(include: Union[list[str], None] = None, exclude: [str] = ()) -> [str]:
+    """
+    Git pathspecs of the card files: the .md files of the deck folders,
+    of the included decks only when given, but of none of the excluded ones
+    """
+    if include is None:
+        specs = [":(glob)*/**/*.md"]
+    else:
+        specs = [f":(glob){glob_escape(deck)}/**/*.md" for deck in include]
+    return specs + [f":(glob,exclude){glob_escape(deck)}/**" for deck in exclude]
+
+
+def glob_escape(name: str) -> str:
+    """
+    Name matching itself only in a glob pathspec, like a deck folder named "C++ [2024]"
+    """
+    return re.sub(r"([*?\[\\])", r"\\\1", name)
+
+
+def is_deck_synced(name: str, include: Union[list[str], None] = None, exclude: [str] = ()) -> bool:
+    return (include is None or name in include) and name not in exclude
+
+
+def parse_raw_diff(out: bytes) -> [RawChange]:
+    """
+    Parse the output of `git diff --raw -z --no-abbrev`
+    """
+    changes = []
+    fields = out.split(b"\0")
+    n = 0
+    while n < len(fields) and fields[n].startswith(b":"):
+        # ":<old mode> <new mode> <old oid> <new oid> <status>[<score>]"
+        (_, _, old_oid, new_oid, status) = fields[n][1:].decode("utf-8").split(" ")
+        status = status[0]
+        old_path = fields[n + 1].decode("utf-8")
+        if status in ("R", "C"):
+            new_path = fields[n + 2].decode("utf-8")
+            n += 3
+        else:
+            new_path = old_path
+            n += 2
+        changes.append(RawChange(status, old_oid, new_oid, old_path, new_path))
+    return changes
 
 
 class Git:
+    """
+    Git commands of the card repository, run in the current directory.
+    Objects and refs are read in process from the repository files when possible,
+    else through a long-lived `git cat-file --batch` process
+    started on first use and stopped by close(), or when used as a context manager.
+    """
+
     def __init__(self):
-        self.cmd = "/usr/bin/git"
+        self.cmd = shutil.which("git") or "git"
+        self.batch = None
+        self.store = None
+
+    def __enter__(self):
+        return self
 
-    def exe(self, *args: str):
-        return subprocess.run([self.cmd] + list(args), capture_output=True)
+    def __exit__(self, *args):
+        self.close()
 
-    def clone(self, url: str, to: str):
-        self.exe("clone", url, to)
+    def exe(self, *args: str, input: Union[bytes, None] = None):
+        return subprocess.run([self.cmd] + list(args), capture_output=True, input=input)
+
+    def clone(self, url: str, to: str, filter: Union[str, None] = None, depth: int = 0,
+              sparse: Union[list[str], None] = None):
+        """
+        filter: partial clone filter, like "blob:none", the missing blobs are fetched when read
+        depth: number of commits of a shallow clone, 0 for the whole history
+        sparse: gitignore like patterns of the files to check out, None for all of them
+        """
+        args = ["clone"]
+        if filter:
+            args.append(f"--filter={filter}")
+        if depth:
+            args.append(f"--depth={depth}")
+        if sparse is not None:
+            args.append("--no-checkout")
+        self.exe(*args, url, to)
+
+        if sparse is not None:
+            self.exe("-C", to, "sparse-checkout", "set", "--no-cone", *sparse)
+            self.exe("-C", to, "checkout")
 
     def pull(self) -> str:
         return self.exe("pull").stdout.decode("utf-8")
 
+    def fetch(self) -> bool:
+        return self.exe("fetch", "--quiet").returncode == 0
+
+    def is_ancestor(self, rev: str, of: str) -> bool:
+        return self.exe("merge-base", "--is-ancestor", rev, of).returncode == 0
+
+    def fast_forward(self, rev: str) -> bool:
+        return self.exe("merge", "--ff-only", "--quiet", rev).returncode == 0
+
+    def _batch(self) -> subprocess.Popen:
+        if self.batch is None or self.batch.poll() is not None:
+            self.batch = subprocess.Popen(
+                [self.cmd, "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        return self.batch
+
+    def _store(self) -> Union[ObjectStore, None]:
+        if self.store is None:
+            self.store = ObjectStore.find(os.getcwd()) or False
+        return self.store or None
+
+    def cat(self, obj: str) -> Union[bytes, None]:
+        """
+        Content of an object given by name (oid, rev:path, ...), None when it does not exist
+        """
+        store = self._store()
+        oid = obj if OID.fullmatch(obj) else None
+        if oid is None and store is not None:
+            try:
+                oid = store.lookup(obj)
+            except (OSError, ValueError, zlib.error):
+                oid = None
+        if oid is not None:
+            content = _blob_cache.get(oid)
+            if content is not None:
+                return content
+            if store is not None:
+                try:
+                    found = store.read(oid)
+                except (OSError, ValueError, zlib.error):
+                    found = None
+                if found is not None:
+                    _blob_cache.put(oid, found[1])
+                    return found[1]
+
+        # The header of cat-file --batch gives the oid along with the content
+        found = self._cat_file(obj if oid is None else oid)
+        if found is None:
+            return None
+        _blob_cache.put(*found)
+        return found[1]
+
+    def _cat_file(self, obj: str) -> Union[tuple[str, bytes], None]:
+        """
+        Oid and content of an object read by git cat-file
+        """
+        for attempt in range(2):
+            batch = self._batch()
+            try:
+                batch.stdin.write(bytes(obj, "utf-8") + b"\n")
+                batch.stdin.flush()
+                header = batch.stdout.readline()
+                if not header:
+                    raise BrokenPipeError("git cat-file exited")
+                # "<oid> <type> <size>" or "<obj> missing" / "<obj> ambiguous"
+                parts = header.split()
+                if parts[-1] in (b"missing", b"ambiguous"):
+                    return None
+                oid = parts[0].decode("utf-8")
+                content = batch.stdout.read(int(parts[2]))
+                batch.stdout.read(1)
+                return (oid, content)
+            except (OSError, ValueError):
+                # The process died or is out of sync, start a new one and retry once
+                self.close()
+                if attempt == 1:
+                    raise
+
+    def _cat_files(self, objects: [str]) -> dict[str, Union[bytes, None]]:
+        """
+        Contents of many objects read by the cat-file process in one pass, None for the missing ones.
+        The names are written by a thread while the answers are read, so that no pipe fills up.
+        """
+        batch = self._batch()
+
+        def write():
+            try:
+                for obj in objects:
+                    batch.stdin.write(bytes(obj, "utf-8") + b"\n")
+                batch.stdin.flush()
+            except (OSError, ValueError):
+                # The process died, the reader sees it too
+                pass
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        contents = {}
+        try:
+            for obj in objects:
+                header = batch.stdout.readline()
+                if not header:
+                    raise BrokenPipeError("git cat-file exited")
+                parts = header.split()
+                if parts[-1] in (b"missing", b"ambiguous"):
+                    contents[obj] = None
+                    continue
+                content = batch.stdout.read(int(parts[2]))
+                batch.stdout.read(1)
+                _blob_cache.put(parts[0].decode("utf-8"), content)
+                contents[obj] = content
+        except (OSError, ValueError):
+            # Read the rest one by one, each with a retry
+            self.close()
+            writer.join()
+            for obj in objects:
+                if obj not in contents:
+                    found = self._cat_file(obj)
+                    contents[obj] = None if found is None else found[1]
+        writer.join()
+        return contents
+
+    def prefetch(self, oids: [str]) -> bool:
+        """
+        Fetch at once the objects missing from a partial clone,
+        instead of one by one when git reads them. False when it is not a partial clone.
+        """
+        store = self._store()
+        remote = store.promisor_remote() if store is not None else None
+        if remote is None:
+            return False
+        out = self.exe(
+            "-c", "fetch.negotiationAlgorithm=noop", "fetch", remote, "--no-tags",
+            "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin",
+            input=bytes("\n".join(oids) + "\n", "utf-8"),
+        )
+        return out.returncode == 0
+
+    def rev_parse(self, rev: str) -> Union[str, None]:
+        oid = None
+        store = self._store()
+        if store is not None:
+            try:
+                oid = store.resolve(rev)
+            except (OSError, ValueError, zlib.error):
+                oid = None
+        if oid is not None:
+            return oid
+        out = self.exe("rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}")
+        return out.stdout.decode("utf-8").strip() or None
+
+    def ls_tree(self, rev: str, path: str = "") -> [TreeEntry]:
+        """
+        Entries of the folder path at the revision
+        """
+        entries = None
+        store = self._store()
+        if store is not None:
+            try:
+                entries = store.tree(rev, path)
+            except (OSError, ValueError, zlib.error):
+                entries = None
+        if entries is not None:
+            return entries
+        tree = self._cat_file(f"{rev}:{path}")
+        return [] if tree is None else parse_tree(tree[1])
+
     def show(self, rev: str, file: str) -> str:
-        return self.exe("--no-pager", "show", f"{rev}:{file}").stdout.decode("utf-8")
+        return self.blob(f"{rev}:{file}")
 
-    def diff(self, from_rev: str, to_rev: str) -> str:
-        return self.exe("--no-pager", "diff", f"{from_rev}..{to_rev}").stdout.decode(
+    def show_many(self, objects: [str]) -> dict[str, str]:
+        """
+        Content of many objects given by name, "" for the missing ones.
+        Those the object store cannot read are asked to the cat-file process in one pass.
+        """
+        contents = {}
+        # Objects the store knows of but does not have, like the blobs of a partial clone
+        missing = {}
+        store = self._store()
+        if store is not None:
+            for obj in dict.fromkeys(objects):
+                try:
+                    oid = store.lookup(obj)
+                    if oid is None:
+                        continue
+                    content = _blob_cache.get(oid)
+                    if content is None:
+                        found = store.read(oid)
+                        content = None if found is None else found[1]
+                except (OSError, ValueError, zlib.error):
+                    continue
+                if content is not None:
+                    _blob_cache.put(oid, content)
+                    contents[obj] = content.decode("utf-8")
+                else:
+                    missing[obj] = oid
+
+        if missing and self.prefetch(list(missing.values())):
+            for (obj, oid) in missing.items():
+                try:
+                    found = store.read(oid)
+                except (OSError, ValueError, zlib.error):
+                    continue
+                if found is not None:
+                    _blob_cache.put(oid, found[1])
+                    contents[obj] = found[1].decode("utf-8")
+
+        rest = [obj for obj in dict.fromkeys(objects) if obj not in contents]
+        if rest:
+            for (obj, content) in self._cat_files(rest).items():
+                contents[obj] = "" if content is None else content.decode("utf-8")
+        return contents
+
+    def blob(self, oid: str) -> str:
+        content = self.cat(oid)
+        return "" if content is None else content.decode("utf-8")
+
+    def diff(self, from_rev: str, to_rev: str, pathspecs: [str] = ()) -> str:
+        return self.exe("--no-pager", "diff", f"{from_rev}..{to_rev}", "--", *pathspecs).stdout.decode(
             "utf-8"
         )
+
+    def diff_lines(self, from_rev: str, to_rev: str, pathspecs: [str] = ()) -> Iterator[bytes]:
+        """
+        Lines of the diff of the revisions, read as git writes them
+        """
+        process = subprocess.Popen(
+            [self.cmd, "--no-pager", "diff", f"{from_rev}..{to_rev}", "--", *pathspecs],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            yield from process.stdout
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                # The reader stopped early
+                process.kill()
+            process.wait()
+
+    def diff_raw(self, from_rev: str, to_rev: str, pathspecs: [str] = ()) -> [RawChange]:
+        return parse_raw_diff(
+            self.exe(
+                "--no-pager", "diff", "--raw", "-z", "--no-abbrev", "--find-renames",
+                f"{from_rev}..{to_rev}", "--", *pathspecs,
+            ).stdout
+        )
+
+    def diff_blobs(self, from_oid: str, to_oid: str) -> str:
+        return self.exe("--no-pager", "diff", from_oid, to_oid).stdout.decode("utf-8")
+
+    def diff_blobs_many(self, pairs: [tuple[str, str]]) -> dict[tuple[str, str], str]:
+        """
+        Diffs of many pairs of blobs, run concurrently
+        """
+        if not pairs:
+            return {}
+        return run_sync(AsyncGit(self.cmd).diff_blobs_many(pairs))
+
+    def close(self) -> None:
+        if self.store:
+            self.store.close()
+        self.store = None
+        (batch, self.batch) = (self.batch, None)
+        if batch is None:
+            return
+        try:
+            batch.stdin.close()
+            batch.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            batch.kill()
+            batch.wait()
+        batch.stdout.close()
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine to completion from synchronous code, like the QueryOp callbacks
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # Called from a running loop, which cannot be blocked on: use a loop of its own
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+class AsyncGit:
+    """
+    Git commands run as asyncio subprocesses in the current directory,
+    at most `concurrency` of them at once
+    """
+
+    def __init__(self, cmd: Union[str, None] = None, concurrency: int = GIT_CONCURRENCY):
+        self.cmd = cmd or shutil.which("git") or "git"
+        self.concurrency = concurrency
+        self.semaphore = None
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Bound to the loop of its first use
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.semaphore
+
+    async def exe(self, *args: str, input: Union[bytes, None] = None) -> subprocess.CompletedProcess:
+        async with self._semaphore():
+            process = await asyncio.create_subprocess_exec(
+                self.cmd,
+                *args,
+                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            (stdout, stderr) = await process.communicate(input)
+        return subprocess.CompletedProcess([self.cmd] + list(args), process.returncode, stdout, stderr)
+
+    async def diff_blobs(self, from_oid: str, to_oid: str) -> str:
+        return (await self.exe("--no-pager", "diff", from_oid, to_oid)).stdout.decode("utf-8")
+
+    async def diff_blobs_many(self, pairs: [tuple[str, str]]) -> dict[tuple[str, str], str]:
+        pairs = list(dict.fromkeys(pairs))
+        diffs = await asyncio.gather(*[self.diff_blobs(*pair) for pair in pairs])
+        return dict(zip(pairs, diffs))
@@ -0,0 +1,647 @@
+import mmap
+import os
+import re
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import NamedTuple, Union
+
+TYPES = {1: b"commit", 2: b"tree", 3: b"blob", 4: b"tag"}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+# Size of the slices of a pack fed to zlib, the pack itself is never copied
+INFLATE_CHUNK = 64 * 1024
+# Number of inflated objects kept to resolve delta chains
+DELTA_BASE_CACHE = 64
+
+HEX = re.compile(rb"[0-9a-f]{4,40}")
+# A revision followed by ~N, ^N, ~ or ^ suffixes
+ANCESTRY = re.compile(r"(.*?)((?:[~^][0-9]*)+)$")
+
+
+class TreeEntry(NamedTuple):
+    mode: str
+    name: str
+    oid: str
+
+    def is_tree(self) -> bool:
+        return self.mode == "40000"
+
+
+def parse_tree(content: bytes) -> [TreeEntry]:
+    """
+    Entries of a tree object: "<mode> <name>\\0<20 bytes oid>"
+    """
+    entries = []
+    n = 0
+    while n < len(content):
+        space = content.index(b" ", n)
+        nul = content.index(b"\0", space)
+        oid = content[nul + 1:nul + 21].hex()
+        entries.append(TreeEntry(content[n:space].decode("utf-8"), content[space + 1:nul].decode("utf-8"), oid))
+        n = nul + 21
+    return entries
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """
+    Rebuild an object from its base and a pack delta
+    """
+
+    def varint(n):
+        value = shift = 0
+        while True:
+            byte = delta[n]
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            n += 1
+            if not byte & 0x80:
+                return (value, n)
+
+    (base_size, n) = varint(0)
+    (size, n) = varint(n)
+    if base_size != len(base):
+        raise ValueError("delta does not apply to its base")
+
+    out = bytearray()
+    while n < len(delta):
+        op = delta[n]
+        n += 1
+        if op & 0x80:
+            # Copy a slice of the base, offset and size are given by the bits set in op
+            offset = length = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[n] << (8 * i)
+                    n += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    length |= delta[n] << (8 * i)
+                    n += 1
+            out += base[offset:offset + (length or 0x10000)]
+        elif op:
+            # Insert the next op bytes of the delta
+            out += delta[n:n + op]
+            n += op
+        else:
+            raise ValueError("invalid delta opcode")
+
+    if len(out) != size:
+        raise ValueError("delta result has the wrong size")
+    return bytes(out)
+
+
+class Pack:
+    """
+    A packfile and its version 2 index, both memory mapped
+    """
+
+    def __init__(self, idx_path: str):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len(".idx")] + ".pack"
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:8] != b"\377tOc\0\0\0\2":
+            self.close()
+            raise ValueError(f"{idx_path}: only version 2 pack indexes are supported")
+        self.count = int.from_bytes(self.idx[8 + 255 * 4:8 + 256 * 4], "big")
+        self.names = 8 + 256 * 4
+        self.offsets = self.names + self.count * 24
+        self.large_offsets = self.offsets + self.count * 4
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+    def _fanout(self, byte: int) -> int:
+        if byte < 0:
+            return 0
+        start = 8 + byte * 4
+        return int.from_bytes(self.idx[start:start + 4], "big")
+
+    def _name(self, n: int) -> bytes:
+        start = self.names + n * 20
+        return self.idx[start:start + 20]
+
+    def _range(self, prefix: bytes) -> (int, int):
+        """
+        Positions in the index of the oids starting with prefix, the index is sorted
+        """
+        first = prefix[0]
+        (low, high) = (self._fanout(first - 1), self._fanout(first))
+        names = _Names(self, low, high)
+        start = low + bisect_left(names, prefix)
+        return (start, high)
+
+    def find(self, oid: bytes) -> Union[int, None]:
+        """
+        Offset in the pack of the object
+        """
+        (n, high) = self._range(oid)
+        if n == high or self._name(n) != oid:
+            return None
+        return self._offset(n)
+
+    def find_prefix(self, prefix: bytes, odd: bool) -> [bytes]:
+        """
+        Oids of the index starting with prefix, odd when the last nibble of prefix is a half byte
+        """
+        if not prefix:
+            return []
+        (n, high) = self._range(prefix)
+        found = []
+        while n < high and self._name(n).startswith(prefix if not odd else prefix[:-1]):
+            name = self._name(n)
+            if not odd or name[len(prefix) - 1] >> 4 == prefix[-1] >> 4:
+                found.append(name)
+            elif name[len(prefix) - 1] >> 4 > prefix[-1] >> 4:
+                break
+            n += 1
+        return found
+
+    def _offset(self, n: int) -> int:
+        start = self.offsets + n * 4
+        offset = int.from_bytes(self.idx[start:start + 4], "big")
+        if offset & 0x80000000:
+            start = self.large_offsets + (offset & 0x7fffffff) * 8
+            offset = int.from_bytes(self.idx[start:start + 8], "big")
+        return offset
+
+    def inflate(self, offset: int, size: int) -> bytes:
+        d = zlib.decompressobj()
+        view = memoryview(self.pack)
+        out = []
+        try:
+            while not d.eof:
+                chunk = view[offset:offset + INFLATE_CHUNK]
+                if not chunk:
+                    raise ValueError(f"{self.pack_path}: truncated object")
+                out.append(d.decompress(chunk))
+                offset += len(chunk)
+        finally:
+            view.release()
+        content = b"".join(out)
+        if len(content) != size:
+            raise ValueError(f"{self.pack_path}: object has the wrong size")
+        return content
+
+    def header(self, offset: int) -> (int, int, int):
+        """
+        Type and size of the object at offset, and the offset after the header
+        """
+        byte = self.pack[offset]
+        kind = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        offset += 1
+        while byte & 0x80:
+            byte = self.pack[offset]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            offset += 1
+        return (kind, size, offset)
+
+    def base_offset(self, offset: int) -> (int, int):
+        """
+        Relative offset of the base of an OFS_DELTA, and the offset after it
+        """
+        byte = self.pack[offset]
+        value = byte & 0x7f
+        offset += 1
+        while byte & 0x80:
+            byte = self.pack[offset]
+            value = ((value + 1) << 7) | (byte & 0x7f)
+            offset += 1
+        return (value, offset)
+
+
+class _Names:
+    """
+    The oids of a pack index between low and high, as a sequence for bisect
+    """
+
+    def __init__(self, pack: Pack, low: int, high: int):
+        self.pack = pack
+        self.low = low
+        self.high = high
+
+    def __len__(self):
+        return self.high - self.low
+
+    def __getitem__(self, n):
+        return self.pack._name(self.low + n)
+
+
+class ObjectStore:
+    """
+    Read only access to the objects and refs of a git repository, without running git.
+    Loose objects and packs are read in process, packs through mmap.
+    Every lookup returns None when it cannot be answered here (unknown revision syntax,
+    object only in a promisor remote, ...), callers fall back to the git command.
+    """
+
+    def __init__(self, git_dir: str):
+        self.git_dir = git_dir
+        self.objects = [os.path.join(git_dir, "objects")]
+        self.objects += self._alternates(self.objects[0])
+        self.packs = None
+        self.bases = OrderedDict()
+
+    @classmethod
+    def find(cls, path: str) -> Union["ObjectStore", None]:
+        """
+        Store of the repository containing path, None when there is none or it is not supported
+        """
+        path = os.path.abspath(path)
+        while True:
+            dot_git = os.path.join(path, ".git")
+            if os.path.isdir(dot_git):
+                git_dir = dot_git
+                break
+            if os.path.isfile(dot_git):
+                # Worktrees and submodules: "gitdir: <path>"
+                with open(dot_git) as f:
+                    line = f.read().strip()
+                if not line.startswith("gitdir: "):
+                    return None
+                git_dir = os.path.join(path, line[len("gitdir: "):])
+                break
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+        # Worktrees keep their objects and shared refs in the main repository
+        common = os.path.join(git_dir, "commondir")
+        if os.path.isfile(common):
+            with open(common) as f:
+                common_dir = os.path.join(git_dir, f.read().strip())
+            store = cls(common_dir)
+            store.head_dir = git_dir
+        else:
+            store = cls(git_dir)
+            store.head_dir = git_dir
+
+        if store._object_format() != "sha1":
+            return None
+        return store
+
+    def _config(self) -> str:
+        try:
+            with open(os.path.join(self.git_dir, "config")) as f:
+                return f.read()
+        except OSError:
+            return ""
+
+    def _object_format(self) -> str:
+        match = re.search(r"^\s*objectformat\s*=\s*(\S+)", self._config(), re.MULTILINE | re.IGNORECASE)
+        return match.group(1).lower() if match else "sha1"
+
+    def promisor_remote(self) -> Union[str, None]:
+        """
+        Remote the missing objects of a partial clone are fetched from
+        """
+        remote = None
+        for line in self._config().splitlines():
+            line = line.strip()
+            section = re.match(r'\[remote\s+"(.*)"\]', line)
+            if section:
+                remote = section.group(1)
+            elif line.startswith("["):
+                remote = None
+            elif remote is not None and re.fullmatch(r"promisor\s*=\s*true", line, re.IGNORECASE):
+                return remote
+        return None
+
+    @staticmethod
+    def _alternates(objects: str) -> [str]:
+        try:
+            with open(os.path.join(objects, "info", "alternates")) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return []
+        return [
+            os.path.join(objects, line) for line in lines if line and not line.startswith("#")
+        ]
+
+    def close(self) -> None:
+        for pack in self.packs or []:
+            pack.close()
+        self.packs = None
+        self.bases.clear()
+
+    def _packs(self, reload: bool = False) -> [Pack]:
+        if self.packs is not None and not reload:
+            return self.packs
+        known = {pack.idx_path: pack for pack in self.packs or []}
+        packs = []
+        for objects in self.objects:
+            folder = os.path.join(objects, "pack")
+            try:
+                names = sorted(os.listdir(folder))
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith(".idx"):
+                    continue
+                path = os.path.join(folder, name)
+                if path in known:
+                    packs.append(known.pop(path))
+                    continue
+                try:
+                    packs.append(Pack(path))
+                except (OSError, ValueError):
+                    continue
+        for pack in known.values():
+            pack.close()
+        self.packs = packs
+        return packs
+
+    # Objects
+
+    def read(self, oid: str) -> Union[tuple[bytes, bytes], None]:
+        """
+        Type and content of the object with the full hex oid
+        """
+        found = self._read_loose(oid)
+        if found is not None:
+            return found
+        binary = bytes.fromhex(oid)
+        for reload in (False, True):
+            # A pack may have been added since the list was read (fetch, gc)
+            for pack in self._packs(reload):
+                offset = pack.find(binary)
+                if offset is not None:
+                    return self._read_packed(pack, offset)
+        return None
+
+    def _read_loose(self, oid: str) -> Union[tuple[bytes, bytes], None]:
+        for objects in self.objects:
+            try:
+                with open(os.path.join(objects, oid[:2], oid[2:]), "rb") as f:
+                    raw = zlib.decompress(f.read())
+            except OSError:
+                continue
+            nul = raw.index(b"\0")
+            (kind, size) = raw[:nul].split(b" ")
+            content = raw[nul + 1:]
+            if int(size) != len(content):
+                raise ValueError(f"loose object {oid} has the wrong size")
+            return (kind, content)
+        return None
+
+    def _read_packed(self, pack: Pack, offset: int) -> Union[tuple[bytes, bytes], None]:
+        # Walk the delta chain down to a full object, then apply the deltas back up
+        deltas = []
+        while True:
+            key = (pack.pack_path, offset)
+            if key in self.bases:
+                self.bases.move_to_end(key)
+                (kind, content) = self.bases[key]
+                break
+
+            (kind, size, data) = pack.header(offset)
+            if kind == OFS_DELTA:
+                (relative, data) = pack.base_offset(data)
+                deltas.append((key, pack, data, size))
+                offset -= relative
+            elif kind == REF_DELTA:
+                base_oid = pack.pack[data:data + 20].hex()
+                deltas.append((key, pack, data + 20, size))
+                found = self._locate(base_oid)
+                if found is None:
+                    # The base lives outside of the packs
+                    loose = self._read_loose(base_oid)
+                    if loose is None:
+                        return None
+                    (kind, content) = loose
+                    break
+                (pack, offset) = found
+            elif kind in TYPES:
+                kind = TYPES[kind]
+                content = pack.inflate(data, size)
+                self._cache(key, kind, content)
+                break
+            else:
+                raise ValueError(f"{pack.pack_path}: unknown object type {kind}")
+
+        for (key, delta_pack, data, size) in reversed(deltas):
+            content = apply_delta(content, delta_pack.inflate(data, size))
+            self._cache(key, kind, content)
+        return (kind, content)
+
+    def _locate(self, oid: str) -> Union[tuple[Pack, int], None]:
+        binary = bytes.fromhex(oid)
+        for pack in self._packs():
+            offset = pack.find(binary)
+            if offset is not None:
+                return (pack, offset)
+        return None
+
+    def _cache(self, key, kind: bytes, content: bytes):
+        self.bases[key] = (kind, content)
+        if len(self.bases) > DELTA_BASE_CACHE:
+            self.bases.popitem(last=False)
+
+    def _expand(self, prefix: str) -> Union[str, None]:
+        """
+        Full oid of an abbreviated one, None when it is unknown or ambiguous
+        """
+        if len(prefix) == 40:
+            return prefix
+        found = set()
+        for objects in self.objects:
+            try:
+                names = os.listdir(os.path.join(objects, prefix[:2]))
+            except OSError:
+                continue
+            found.update(prefix[:2] + name for name in names if name.startswith(prefix[2:]))
+        odd = len(prefix) % 2 == 1
+        binary = bytes.fromhex(prefix + "0" if odd else prefix)
+        for pack in self._packs():
+            found.update(name.hex() for name in pack.find_prefix(binary, odd))
+        if len(found) != 1:
+            return None
+        return found.pop()
+
+    # Refs
+
+    def ref(self, name: str) -> Union[str, None]:
+        """
+        Oid a ref points to, following symbolic refs
+        """
+        for _ in range(10):
+            value = self._ref_value(name)
+            if value is None:
+                return None
+            if not value.startswith("ref: "):
+                return value
+            name = value[len("ref: "):]
+        return None
+
+    def _ref_value(self, name: str) -> Union[str, None]:
+        # HEAD and the per worktree refs are in the worktree folder, the others are shared
+        folders = [self.head_dir] if "/" not in name else []
+        folders.append(self.git_dir)
+        for folder in folders:
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    return f.read().strip()
+            except OSError:
+                continue
+        return self._packed_refs().get(name)
+
+    def _packed_refs(self) -> dict[str, str]:
+        refs = {}
+        try:
+            with open(os.path.join(self.git_dir, "packed-refs")) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return refs
+        for line in lines:
+            if not line or line[0] in "#^":
+                continue
+            (oid, name) = line.split(" ", 1)
+            refs[name] = oid
+        return refs
+
+    def resolve(self, rev: str) -> Union[str, None]:
+        """
+        Oid of a revision: an oid or its abbreviation, a ref name, followed by ~N or ^N.
+        Annotated tags are peeled to the object they tag, like `git rev-parse {rev}^{commit}`.
+        """
+        match = ANCESTRY.match(rev)
+        if match and match.group(1):
+            oid = self.resolve(match.group(1))
+            for step in re.findall(r"[~^][0-9]*", match.group(2)):
+                if oid is None:
+                    return None
+                count = int(step[1:]) if len(step) > 1 else 1
+                if step[0] == "~":
+                    for _ in range(count):
+                        oid = self._parent(oid, 1)
+                        if oid is None:
+                            return None
+                elif count:
+                    oid = self._parent(oid, count)
+            return oid
+
+        for name in (rev, f"refs/{rev}", f"refs/tags/{rev}", f"refs/heads/{rev}",
+                     f"refs/remotes/{rev}", f"refs/remotes/{rev}/HEAD"):
+            if "/" not in name and name != "HEAD" and not name.endswith("_HEAD"):
+                continue
+            oid = self.ref(name)
+            if oid is not None:
+                return self._peel_tags(oid)
+
+        if HEX.fullmatch(rev.encode("utf-8")):
+            oid = self._expand(rev)
+            return None if oid is None else self._peel_tags(oid)
+        return None
+
+    def _peel_tags(self, oid: str) -> Union[str, None]:
+        """
+        Object tagged by a chain of annotated tags, the oid itself for any other object
+        """
+        while True:
+            found = self.read(oid)
+            if found is None:
+                return None
+            (kind, content) = found
+            if kind != b"tag":
+                return oid
+            (field, value) = content.split(b"\n", 1)[0].split(b" ", 1)
+            if field != b"object":
+                return None
+            oid = value.decode("utf-8")
+
+    def _peel(self, oid: str, kind: bytes) -> Union[tuple[str, bytes], None]:
+        """
+        Follow tags and commits down to an object of the given kind
+        """
+        while True:
+            found = self.read(oid)
+            if found is None:
+                return None
+            (obj_kind, content) = found
+            if obj_kind == kind:
+                return (oid, content)
+            if obj_kind in (b"tag", b"commit"):
+                # Both start with the object they point to
+                (field, value) = content.split(b"\n", 1)[0].split(b" ", 1)
+                if field not in (b"object", b"tree"):
+                    return None
+                oid = value.decode("utf-8")
+            else:
+                return None
+
+    def _shallow(self) -> set[str]:
+        """
+        Commits of a shallow clone whose parents were not fetched
+        """
+        try:
+            with open(os.path.join(self.git_dir, "shallow")) as f:
+                return set(f.read().split())
+        except OSError:
+            return set()
+
+    def _parent(self, oid: str, n: int) -> Union[str, None]:
+        commit = self._peel(oid, b"commit")
+        if commit is None or commit[0] in self._shallow():
+            return None
+        parents = [
+            line[len(b"parent "):].decode("utf-8")
+            for line in commit[1].split(b"\n\n", 1)[0].splitlines()
+            if line.startswith(b"parent ")
+        ]
+        return parents[n - 1] if len(parents) >= n else None
+
+    # Trees
+
+    def tree(self, rev: str, path: str = "") -> Union[list[TreeEntry], None]:
+        """
+        Entries of the folder path at the revision
+        """
+        oid = self.resolve(rev)
+        if oid is None:
+            return None
+        tree = self._peel(oid, b"tree")
+        if tree is None:
+            return None
+        for name in [p for p in path.split("/") if p]:
+            entry = next((e for e in parse_tree(tree[1]) if e.name == name), None)
+            if entry is None or not entry.is_tree():
+                return None
+            tree = self.read(entry.oid)
+            if tree is None:
+                return None
+            tree = (entry.oid, tree[1])
+        return parse_tree(tree[1])
+
+    def lookup(self, obj: str) -> Union[str, None]:
+        """
+        Oid of an object name: a revision, or "<rev>:<path>" for a file of its tree
+        """
+        if ":" not in obj:
+            return self.resolve(obj)
+        (rev, path) = obj.split(":", 1)
+        (folder, _, name) = path.rstrip("/").rpartition("/")
+        entries = self.tree(rev, folder)
+        if entries is None:
+            return None
+        entry = next((e for e in entries if e.name == name), None)
+        return None if entry is None else entry.oid
+
+    def cat(self, obj: str) -> Union[bytes, None]:
+        """
+        Content of an object given by name
+        """
+        oid = self.lookup(obj)
+        if oid is None:
+            return None
+        found = self.read(oid)
+        return None if found is None else found[1]
@@ -14,3 +14,15 @@ class EmbedLatex(marko.inline.InlineElement):
 class EmbedLatexMixin(object):
     def render_embed_latex(self, element):
         return '{}'.format(element.source)
+
+
+class CardHeading(marko.block.Heading):
+    """
+    ATX heading remembering the offset of its line in the parsed text,
+    used to slice the cards out of a parsed file
+    """
+    override = True
+
+    def __init__(self, match: re.Match) -> None:
+        super().__init__(match)
+        self.offset = match.start()
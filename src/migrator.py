@@ -3,7 +3,7 @@ import anki
 import pathlib
 from typing import Union
 from .gen_md import DeckGenerator
-from .utils import get_stripped_lines, hash_card
+from .utils import get_stripped_lines, hash_card, merge_undo
 from .migrators.mdanki import MdAnkiMigrator
 
 
@@ -48,6 +48,7 @@ def convert(noteid, card, modelid, collection):
     note.fields[2] = card[2]
 
     collection.update_note(note)
+    merge_undo(collection)
 
 
 def migrate_old_card(deck: anki.decks.Deck, folder: pathlib.Path, collection: anki.collection.Collection):
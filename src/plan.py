@@ -0,0 +1,121 @@
+import re
+from typing import NamedTuple, Union
+
+# (recto, verso, hash) of a note, as generated by MdFile.gen_card
+Note = tuple[str, str, str]
+
+
+class CardSource(NamedTuple):
+    """
+        A card of an added file, rendered into its note when it is written:
+        the cards already in the deck are then never rendered.
+        hash: Hash of source, third like the hash of a Note
+    """
+    source: str
+    extend: bool
+    hash: str
+
+
+def note_title(note: Union[Note, CardSource]) -> str:
+    """
+    First line of the recto of a note without its html, or of the card not rendered yet, to print it
+    """
+    if isinstance(note, CardSource):
+        text = note.source.lstrip("#").strip()
+    else:
+        text = re.sub(r"<[^>]+>", "", note[0]).strip()
+    return text.split("\n", 1)[0]
+
+
+class DeckChanges(NamedTuple):
+    """
+        Changes of the cards of one deck, by card hash.
+        adds: notes of the new cards, or the cards of added files when not rendered yet
+        updates: hash of the old card and note of the card replacing it
+        deletes: hashes of the cards removed
+    """
+    adds: tuple[Union[Note, CardSource], ...] = ()
+    updates: tuple[tuple[str, Note], ...] = ()
+    deletes: tuple[str, ...] = ()
+
+    def __len__(self) -> int:
+        return len(self.adds) + len(self.updates) + len(self.deletes)
+
+
+class ChangePlan(NamedTuple):
+    """
+        Every change of a sync, computed from the repository alone.
+        decks: changes of each deck by deck name, sorted by name
+        moves: (deck the card leaves, deck it goes to, hash) of the cards moved with their note
+    """
+    rev_from: str
+    rev_to: str
+    decks: tuple[tuple[str, DeckChanges], ...] = ()
+    moves: tuple[tuple[str, str, str], ...] = ()
+
+    def deck(self, name: str) -> DeckChanges:
+        for (deck, changes) in self.decks:
+            if deck == name:
+                return changes
+        return DeckChanges()
+
+    def __str__(self):
+        lines = [f"Plan {self.rev_from}..{self.rev_to}"]
+        for (from_deck, to_deck, card_hash) in self.moves:
+            lines.append(f"  {from_deck} -> {to_deck}: {card_hash[:12]}")
+        for (deck, changes) in self.decks:
+            lines.append(
+                f"{deck}: {len(changes.adds)} added, {len(changes.updates)} updated, {len(changes.deletes)} deleted"
+            )
+            lines += [f"  + {note_title(note)}" for note in changes.adds]
+            lines += [f"  ~ {note_title(note)}" for (_, note) in changes.updates]
+            lines += [f"  - {card_hash[:12]}" for card_hash in changes.deletes]
+        return "\n".join(lines)
+
+
+class PlanBuilder:
+    """
+    Changes collected while reading the files of a diff, frozen into a ChangePlan by build()
+    """
+
+    def __init__(self):
+        # Deck name -> (hash -> note added, old hash -> note updated, hashes deleted)
+        self.decks = {}
+        # (from deck, hash) -> to deck
+        self.moves = {}
+
+    def _deck(self, deck: str) -> (dict, dict, dict):
+        if deck not in self.decks:
+            self.decks[deck] = ({}, {}, {})
+        return self.decks[deck]
+
+    def add(self, deck: str, note: Union[Note, CardSource]) -> None:
+        self._deck(deck)[0][note[2]] = note
+
+    def update(self, deck: str, card_hash: str, note: Note) -> None:
+        self._deck(deck)[1][card_hash] = note
+
+    def delete(self, deck: str, card_hash: str) -> None:
+        self._deck(deck)[2][card_hash] = None
+
+    def move(self, from_deck: str, to_deck: str, card_hash: str) -> None:
+        self.moves[(from_deck, card_hash)] = to_deck
+
+    def merge(self, other: "PlanBuilder") -> None:
+        """
+        Add the changes of a builder filled after this one, as if they were made on this one
+        """
+        for deck, (adds, updates, deletes) in other.decks.items():
+            (own_adds, own_updates, own_deletes) = self._deck(deck)
+            own_adds.update(adds)
+            own_updates.update(updates)
+            own_deletes.update(deletes)
+        self.moves.update(other.moves)
+
+    def build(self, rev_from: str = "", rev_to: str = "") -> ChangePlan:
+        decks = tuple(
+            (deck, DeckChanges(tuple(adds.values()), tuple(updates.items()), tuple(deletes)))
+            for deck, (adds, updates, deletes) in sorted(self.decks.items())
+        )
+        moves = tuple((from_deck, to_deck, card_hash) for (from_deck, card_hash), to_deck in self.moves.items())
+        return ChangePlan(rev_from, rev_to, decks, moves)
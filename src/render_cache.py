@@ -0,0 +1,47 @@
+import hashlib
+import inspect
+import marko
+
+from .sqlite_lru import SqliteLru
+
+# Bump when the way cards are split or rendered changes the produced html
+RENDER_VERSION = 4
+
+
+def renderer_version(*extensions: marko.MarkoExtension) -> str:
+    """
+    Fingerprint of marko and of the extensions used to render cards.
+    Any change of it drops the whole cache.
+    """
+    parts = [str(RENDER_VERSION), marko.__version__]
+    for extension in extensions:
+        for item in extension.elements + extension.parser_mixins + extension.renderer_mixins:
+            parts.append(f"{item.__module__}.{item.__qualname__}")
+            try:
+                parts.append(inspect.getsource(item))
+            except (OSError, TypeError):  # pragma: no cover
+                pass
+    return hashlib.sha256(bytes("\0".join(parts), "utf-8")).hexdigest()
+
+
+class RenderCache(SqliteLru):
+    """
+        On-disk cache of rendered cards: (card hash, extend) -> (recto, verso).
+        Least recently used entries are evicted once the html stored exceeds max_bytes.
+    """
+
+    def __init__(self, path: str, version: str, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__(path, "render", ["hash text", "extend integer"], ["recto text", "verso text"], max_bytes)
+        self.db.execute("create table if not exists meta (key text primary key, value text)")
+        row = self.db.execute("select value from meta where key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            self.db.execute("delete from render")
+            self.db.execute("insert or replace into meta values ('version', ?)", (version,))
+            self.db.commit()
+            self.load()
+
+    def get(self, card_hash: str, extend: bool) -> (str, str):
+        return self.read((card_hash, int(extend)))
+
+    def put(self, card_hash: str, extend: bool, recto: str, verso: str) -> None:
+        self.write((card_hash, int(extend)), (recto, verso), len(recto) + len(verso))
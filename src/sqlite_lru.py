@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+
+
+class SqliteLru:
+    """
+        Table of an sqlite file whose least recently used rows are evicted
+        once the size of their values exceeds max_bytes.
+        table: name of the table, with the key columns, the value columns, size and used
+        keys, values: column definitions, like "hash text"
+    """
+
+    def __init__(self, path: str, table: str, keys: [str], values: [str], max_bytes: int):
+        self.max_bytes = max_bytes
+        self.table = table
+        self.keys = [column.split()[0] for column in keys]
+        self.values = [column.split()[0] for column in values]
+        self.where = " and ".join(f"{key} = ?" for key in self.keys)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.executescript(
+            f"""
+            create table if not exists {table} (
+                {", ".join(keys + values)}, size integer, used integer, primary key ({", ".join(self.keys)})
+            );
+            create index if not exists {table}_used on {table} (used);
+            """
+        )
+        self.load()
+
+    def load(self) -> None:
+        self.size, self.clock = self.db.execute(
+            f"select coalesce(sum(size), 0), coalesce(max(used), 0) from {self.table}"
+        ).fetchone()
+        self.pending = 0
+
+    def _tick(self) -> int:
+        self.clock += 1
+        self.pending += 1
+        if self.pending >= 512:
+            self.db.commit()
+            self.pending = 0
+        return self.clock
+
+    def read(self, key: tuple) -> tuple:
+        """
+        Values of the row of the key, None when there is none
+        """
+        with self.lock:
+            row = self.db.execute(
+                f"select {', '.join(self.values)} from {self.table} where {self.where}", key
+            ).fetchone()
+            if row is not None:
+                self.db.execute(f"update {self.table} set used = ? where {self.where}", (self._tick(),) + key)
+            return row
+
+    def write(self, key: tuple, values: tuple, size: int, replace: bool = True) -> None:
+        """
+        Store the values of the key, or keep those already stored unless replace
+        """
+        with self.lock:
+            old = self.db.execute(f"select size from {self.table} where {self.where}", key).fetchone()
+            if old is not None and not replace:
+                return
+            marks = ", ".join("?" * (len(key) + len(values) + 2))
+            self.db.execute(
+                f"insert or replace into {self.table} values ({marks})", key + values + (size, self._tick())
+            )
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Free a bit more than needed so that eviction does not run on every put
+        target = self.max_bytes * 0.9
+        rows = self.db.execute(f"select {', '.join(self.keys)}, size from {self.table} order by used")
+        evicted = []
+        for row in rows:
+            if self.size <= target:
+                break
+            evicted.append(row[:-1])
+            self.size -= row[-1]
+        self.db.executemany(f"delete from {self.table} where {self.where}", evicted)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute(f"select count(*) from {self.table}").fetchone()[0]
+
+    def flush(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
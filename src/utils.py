@@ -1,27 +1,172 @@
 import anki
 import hashlib
+from typing import NamedTuple
+from anki.collection import AddNoteRequest
+from anki.errors import NotFoundError
+from anki.utils import ids2str, split_fields
+
+# Notes sent to the backend in one add_notes call
+ADD_NOTES_CHUNK = 1000
+
+static_html = """
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.css" integrity="sha384-nB0miv6/jRmo5UMMR1wu3Gz6NLsoTkbqJghGIsx//Rlm+ZU03BU6SQNC66uf4l5+" crossorigin="anonymous">
+<script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/katex.min.js" integrity="sha384-7zkQWkzuo3B5mTepMUcHkMB5jZaolc2xDwL6VFqjFALcbeS9Ggm/Yr2r3Dy4lfFg" crossorigin="anonymous"></script>
+<script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.11/dist/contrib/auto-render.min.js" integrity="sha384-43gviWU0YVjaDtb/GhzOouOXtZMP/7XUzwPTstBeZFe/+rCMvRwr4yROQP43s0Xk" crossorigin="anonymous" onload="renderMathInElement(document.body);"></script>
+"""
 
 
 def get_stripped_lines(s: str) -> [str]:
     return [line.strip() for line in s.splitlines()]
 
 
+def is_card_start(line: str) -> bool:
+    """
+    Cards of a file start at every line beginning with ##, headings or not, as they always did:
+    the hashes of the notes of the decks depend on it
+    """
+    return line.strip().startswith("##")
+
+
+def hash_source(s: str) -> str:
+    return hashlib.sha512(bytes(s, "utf-8")).hexdigest()
+
+
+class Card(NamedTuple):
+    """
+        A card split out of a markdown file.
+        source: Stripped lines of the card joined by newlines
+        hash: Hash of source, stored in the Hash field of the note
+        extend: Recto and verso are separated by a % line
+    """
+    source: str
+    hash: str
+    extend: bool
+
+    @classmethod
+    def from_lines(cls, lines: [str]) -> "Card":
+        source = "\n".join(lines)
+        return cls(source, hash_source(source), any([line.startswith("%") for line in lines]))
+
+    @classmethod
+    def from_source(cls, s: str) -> "Card":
+        return cls.from_lines(get_stripped_lines(s))
+
+
 def is_extends(s: str):
     return any([i.startswith("%") for i in get_stripped_lines(s)])
 
 
-def add_note_to_deck(notes: [(str, str, str)], mid: int, did: int, collection: anki.collection.Collection):
+def get_note_hashes(did: int, collection: anki.collection.Collection) -> dict[str, int]:
+    """
+        Map the Hash field of every Ankill note of the deck to its note id,
+        read in one query. Cards moved to a filtered deck still belong to their deck (odid).
+        did: Deck id
+    """
+    mid = collection.models.id_for_name("Ankill")
+    rows = collection.db.all(
+        "select distinct n.id, n.flds from notes n join cards c on c.nid = n.id "
+        "where (c.did = ? or c.odid = ?) and n.mid = ?",
+        did,
+        did,
+        mid,
+    )
+    return {split_fields(flds)[2]: nid for nid, flds in rows}
+
+
+def add_note_to_deck(notes: [(str, str, str)], mid: int, did: int, collection: anki.collection.Collection) -> [int]:
     """
         mid: Model id
         did: Deck id
+        Return the ids of the added notes
     """
-    for recto, verso, card_hash in notes:
-        note = collection.new_note(mid)
+    note_ids = []
+    for start in range(0, len(notes), ADD_NOTES_CHUNK):
+        requests = []
+        for recto, verso, card_hash in notes[start:start + ADD_NOTES_CHUNK]:
+            note = collection.new_note(mid)
+            note.fields[0] = recto
+            note.fields[1] = verso
+            note.fields[2] = card_hash
+            requests.append(AddNoteRequest(note, did))
+        collection.add_notes(requests)
+        merge_undo(collection)
+        note_ids.extend([request.note.id for request in requests])
+    return note_ids
+
+
+def update_note_fields(notes: dict[int, (str, str, str)], collection: anki.collection.Collection) -> None:
+    """
+        Write (recto, verso, hash) of the notes, by note id, with one update_notes call
+    """
+    updated = []
+    for nid, (recto, verso, card_hash) in notes.items():
+        try:
+            note = collection.get_note(nid)
+        except NotFoundError:
+            continue
         note.fields[0] = recto
         note.fields[1] = verso
         note.fields[2] = card_hash
-        collection.add_note(note, did)
+        updated.append(note)
+
+    if len(updated) != 0:
+        collection.update_notes(updated)
+        merge_undo(collection)
+
+
+def move_notes_to_deck(nids: [int], did: int, collection: anki.collection.Collection) -> None:
+    """
+        Move the cards of the notes to the deck, keeping their review history
+    """
+    if len(nids) == 0:
+        return
+    cids = collection.db.list(f"select id from cards where nid in {ids2str(nids)}")
+    collection.set_deck(cids, did)
+    merge_undo(collection)
+
+
+class UndoStep:
+    """
+        Merge every change made to the collection inside the block into one undo entry.
+        Anki only keeps the last undo entries, so writes call merge_undo() as they go.
+    """
+    active = {}
+
+    def __init__(self, collection: anki.collection.Collection, name: str = "Ankill sync"):
+        self.collection = collection
+        self.name = name
+
+    def __enter__(self):
+        self.target = self.collection.add_custom_undo_entry(self.name)
+        UndoStep.active[id(self.collection)] = self.target
+        return self
+
+    def __exit__(self, *args):
+        del UndoStep.active[id(self.collection)]
+        self.collection.merge_undo_entries(self.target)
+
+
+def merge_undo(collection: anki.collection.Collection) -> None:
+    target = UndoStep.active.get(id(collection))
+    if target is not None:
+        collection.merge_undo_entries(target)
 
 
 def hash_card(r, v):
     return hashlib.sha512(bytes(f"{r}{v}", "utf-8")).hexdigest()
+
+
+def create_model(collection):
+    model = collection.models.new("Ankill")
+    recto = collection.models.new_field("Recto")
+    collection.models.add_field(model, recto)
+    verso = collection.models.new_field("Verso")
+    collection.models.add_field(model, verso)
+    card_hash = collection.models.new_field("Hash")
+    card_hash["collapsed"] = True
+    collection.models.add_field(model, card_hash)
+    template = collection.models.new_template("Carte")
+    template["qfmt"] = "{{Recto}}" + static_html
+    template["afmt"] = "{{FrontSide}}\n\n<hr id=answer>\n\n{{Verso}}"
+    collection.models.add_template(model, template)
+    return model
@@ -5,11 +5,20 @@ import pathlib
 import shutil
 import subprocess
 import hashlib
+import zlib
 from anki.collection import Collection
-from src.diff import get_note_of_scope, create_note
-from src.gen_md import CardGenerator, DeckGenerator
-from src import create_model, add_note_to_deck, create_decks, fill_decks, refresh_card
-from src.utils import get_stripped_lines, is_extends
+from src.diff import (
+    get_note_of_scope, CardIndex, create_note, ModifiedFile, CardSetFile, DeleteFile, NoteBatch, Diff,
+    iter_patched_files, apply_plan, plan_file, FileChange,
+)
+from src.plan import PlanBuilder, note_title
+from src.gen_md import CardGenerator, DeckGenerator, MdFile, open_render_cache, close_render_cache, worker_pool
+from src.render_cache import RenderCache
+from src import create_model, add_note_to_deck, create_decks, fill_decks, refresh_card, sparse_patterns, fetch_repo
+from src.git import Git, AsyncGit, run_sync, deck_pathspecs, open_blob_cache, close_blob_cache
+from src.blob_cache import BlobCache
+from src.git_objects import ObjectStore
+from src.utils import get_stripped_lines, is_extends, get_note_hashes, Card, UndoStep
 from src.migrator import migrate_old_card, get_from_title
 
 basic_input = """## Blahaj
@@ -163,6 +172,28 @@ def test_table():
     )
 
 
+def test_single_parse_same_as_two_conversions():
+    sources = [
+        (False, "## test\ncontent\n"),
+        (False, "## test\n- a\n- b\n\n```\ncode\n```"),
+        (False, "no heading\nbut *text*"),
+        (False, "## only recto"),
+        (True, "## What is this ?\nDefine what is a blahaj\n%\nA blahaj is a **shark**\n"),
+    ]
+    for extend, source in sources:
+        single = CardGenerator(extend=extend).gen_note(source)
+        double = CardGenerator(extend=extend, single_parse=False).gen_note(source)
+        assert single == double
+
+
+def test_single_parse_reference_link():
+    recto, verso = CardGenerator().gen_note("""## What is a [shark] ?
+
+[shark]: https://blahaj.example""")
+    assert recto == '<h2>What is a <a href="https://blahaj.example">shark</a> ?</h2>\n'
+    assert verso == ""
+
+
 def test_hash():
     recto, verso, hash = CardGenerator().gen_note_with_hash("""## test
 $$ a = b $$
@@ -193,6 +224,54 @@ A blahaj is a shark
     assert verso == "<p>A blahaj is a shark</p>\n"
 
 
+def test_shared_markdown():
+    import threading
+
+    assert CardGenerator().marko is CardGenerator().marko
+
+    engines = []
+    thread = threading.Thread(target=lambda: engines.append(CardGenerator().marko))
+    thread.start()
+    thread.join()
+    assert engines[0] is not CardGenerator().marko
+
+
+def test_render_cache(tmp_path):
+    cache = RenderCache(tmp_path / "cache.sqlite", "v1", max_bytes=25)
+    cache.put("a", False, "recto", "verso")
+    cache.put("b", False, "recto", "verso")
+    assert cache.get("a", False) == ("recto", "verso")
+    assert cache.get("a", True) is None
+
+    # "b" is the least recently used entry
+    cache.put("c", False, "recto", "verso")
+    assert cache.get("b", False) is None
+    assert cache.get("a", False) == ("recto", "verso")
+    cache.close()
+
+    cache = RenderCache(tmp_path / "cache.sqlite", "v1", max_bytes=25)
+    assert len(cache) == 2
+    cache.close()
+
+    cache = RenderCache(tmp_path / "cache.sqlite", "v2", max_bytes=25)
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_card_generator_uses_render_cache(tmp_path):
+    cache = open_render_cache(tmp_path / "cache.sqlite", 1024)
+    try:
+        card = Card.from_source(basic_input)
+        cache.put(card.hash, False, "cached recto", "cached verso")
+        assert CardGenerator().gen_card(card) == ("cached recto", "cached verso", card.hash)
+
+        other = Card.from_source("## Other\ncard")
+        assert CardGenerator().gen_card(other) == ("<h2>Other</h2>\n", "<p>card</p>\n", other.hash)
+        assert cache.get(other.hash, False) == ("<h2>Other</h2>\n", "<p>card</p>\n")
+    finally:
+        close_render_cache()
+
+
 def test_is_model_is_serializable():
     with FakeAnki() as col:
         print(col)
@@ -260,6 +339,63 @@ card2"""
     )
 
 
+def test_note_of_scope_many_notes():
+    source = """## Card1
+card1
+
+## Card2
+card2
+
+## Card3
+card3
+"""
+    assert get_note_of_scope(source, 1) == "## Card1\ncard1"
+    assert get_note_of_scope(source, 4) == "## Card2\ncard2"
+    assert get_note_of_scope(source, 5) == "## Card2\ncard2"
+    assert get_note_of_scope(source, 6) == "## Card3\ncard3"
+
+
+def test_md_file_parses_lazily(tmp_path):
+    source = "## A\na\n\n## B\nb"
+    md_file = MdFile(source)
+    assert len(md_file.cards) == 2 and md_file._doc is None
+
+    open_render_cache(tmp_path / "cache.sqlite", 1024 * 1024)
+    try:
+        rendered = MdFile(source).gen_card(1)
+        md_file = MdFile(source)
+        assert md_file.gen_card(1) == rendered
+        # Read from the cache without parsing the file
+        assert md_file._doc is None
+    finally:
+        close_render_cache()
+
+
+def test_card_index():
+    source = """Preamble
+
+## Card1
+card1
+
+```
+## Not a card
+```
+
+## Card2
+card2
+"""
+    index = CardIndex(source)
+    cards = MdFile(source).cards
+    # A ## line splits cards even inside a code block, as it always did
+    assert index.starts == [0, 2, 6, 9]
+    assert [index.find(n) for n in range(12)] == [0, 0, 1, 1, 1, 1, 2, 2, 2, 3, 3, 3]
+    assert index.find(13) is None
+    # The cards of the deck, so with the same hashes
+    assert index.card(4) == cards[1]
+    assert index.note_of_scope(0) is None
+    assert index.note_of_scope(4) == "## Card1\ncard1\n\n```"
+
+
 def test_is_extends():
     source = """## Card
 the shark
@@ -283,6 +419,92 @@ def test_stripped_lines():
     assert get_stripped_lines(source) == ["## Card", "blahaj"]
 
 
+def test_card():
+    card = Card.from_source("""  ## Card
+  the shark
+%
+blahaj  """)
+    assert card.source == "## Card\nthe shark\n%\nblahaj"
+    assert card.hash == hashlib.sha512(bytes(card.source, "utf-8")).hexdigest()
+    assert card.extend
+
+    recto, verso, hash = CardGenerator(extend=card.extend).gen_card(card)
+    assert recto == "<h2>Card</h2>\n<p>the shark</p>\n"
+    assert verso == "<p>blahaj</p>\n"
+    assert hash == card.hash
+
+
+def test_md_cards():
+    with FakeAnki() as collection:
+        dg = DeckGenerator(1, collection)
+        cards = dg.get_md_cards(get_stripped_lines("""## Blahaj
+the shark
+## The boykisser
+a silly cat"""))
+
+    assert cards == [
+        Card.from_source("## Blahaj\nthe shark"),
+        Card.from_source("## The boykisser\na silly cat"),
+    ]
+
+
+def test_md_file():
+    source = """# Sharks
+
+## Blahaj
+the shark
+
+```
+## not a card
+```
+## What is this ?
+Define what is a blahaj
+%
+A blahaj is a shark
+### The boykisser
+- a silly
+- cat
+"""
+    md_file = MdFile(source)
+    lines = get_stripped_lines(source)
+    assert md_file.cards == [
+        Card.from_lines(lines[0:2]),
+        Card.from_lines(lines[2:6]),
+        Card.from_lines(lines[6:8]),
+        Card.from_lines(lines[8:12]),
+        Card.from_lines(lines[12:]),
+    ]
+    assert md_file.blocks[0] is None and md_file.blocks[1] is None and md_file.blocks[4] is not None
+    for n, card in enumerate(md_file.cards):
+        assert md_file.gen_card(n) == CardGenerator(extend=card.extend).gen_card(card)
+
+
+def test_md_file_card_starts():
+    source = """## Heading
+text
+##No heading
+text
+## Reference
+[a link][ref]
+
+[ref]: https://example.com
+"""
+    md_file = MdFile(source)
+    lines = get_stripped_lines(source)
+    # The cards of the old line splitter
+    assert md_file.cards == [Card.from_lines(lines[0:2]), Card.from_lines(lines[2:4]), Card.from_lines(lines[4:])]
+    # Link references of a file make each card render on its own, as its cache key says
+    assert md_file.blocks == [None, None, None]
+    for n, card in enumerate(md_file.cards):
+        assert md_file.gen_card(n) == CardGenerator(extend=card.extend).gen_card(card)
+    assert MdFile("## Other\n[a link][ref]").gen_card(0)[1] == "<p>[a link][ref]</p>\n"
+
+
+def test_md_file_leading_blank_lines():
+    assert MdFile("\n\n## Blahaj\nthe shark").cards == [Card.from_lines(["## Blahaj", "the shark"])]
+    assert MdFile("").cards == []
+
+
 def test_deck_generator():
     source = """## Blahaj
 the shark
@@ -326,6 +548,71 @@ a silly cat
         assert collection.note_count() == 2
 
 
+def test_note_hashes():
+    with FakeAnki() as collection:
+        collection.models.save(create_model(collection))
+        mid = collection.models.by_name("Ankill")
+        d = collection.decks.new_deck()
+        d.name = "test"
+        collection.decks.add_deck(d)
+        id = collection.decks.id_for_name("test")
+        note_ids = add_note_to_deck([("r1", "v1", "h1"), ("r2", "v2", "h2")], mid, id, collection)
+
+        assert get_note_hashes(id, collection) == {"h1": note_ids[0], "h2": note_ids[1]}
+        assert get_note_hashes(collection.decks.id_for_name("Default"), collection) == {}
+
+        # Cards moved to a filtered deck are still notes of their deck
+        filtered = collection.sched.get_or_create_filtered_deck(0)
+        filtered.name = "filtered"
+        filtered.config.search_terms[0].search = "deck:test"
+        collection.sched.add_or_update_filtered_deck(filtered)
+        assert collection.db.scalar("select count() from cards where did = ?", id) == 0
+        assert get_note_hashes(id, collection) == {"h1": note_ids[0], "h2": note_ids[1]}
+
+
+def test_fill_deck_twice():
+    with FakeAnki() as collection:
+        with FakeFolder() as folder:
+            collection.models.save(create_model(collection))
+            create_decks(folder, [], collection)
+            fill_decks(folder, [], collection)
+            fill_decks(folder, [], collection)
+
+        assert collection.note_count() == 2
+
+
+def test_add_note_to_deck_in_chunks(monkeypatch):
+    import src.utils
+
+    monkeypatch.setattr(src.utils, "ADD_NOTES_CHUNK", 2)
+    with FakeAnki() as collection:
+        collection.models.save(create_model(collection))
+        mid = collection.models.by_name("Ankill")
+        id = collection.decks.id_for_name("Default")
+        # More chunks than the undo entries kept by Anki
+        notes = [(f"r{n}", f"v{n}", f"h{n}") for n in range(81)]
+        with UndoStep(collection):
+            note_ids = add_note_to_deck(notes, mid, id, collection)
+
+        assert len(note_ids) == 81
+        assert [collection.get_note(note_id).fields[2] for note_id in note_ids] == [h for (_, _, h) in notes]
+        collection.undo()
+        assert collection.note_count() == 0
+
+
+def test_fill_deck_one_undo_step():
+    with FakeAnki() as collection:
+        with FakeFolder() as folder:
+            collection.models.save(create_model(collection))
+            create_decks(folder, [], collection)
+            fill_decks(folder, [], collection)
+
+        assert collection.note_count() == 2
+        assert collection.undo_status().undo == "Ankill sync"
+        collection.undo()
+        assert collection.note_count() == 0
+
+
 def test_create_deck():
     with FakeAnki() as collection:
         with FakeFolder() as folder:
@@ -348,6 +635,797 @@ def test_fill_deck():
             assert len(collection.find_notes(f"did:{i.id}")) == 1
 
 
+def test_worker_pool_forks_at_once():
+    with worker_pool(2) as pool:
+        # Forked before the caller starts any thread, not on later submits
+        assert len(pool._processes) == 2
+
+
+def test_fill_deck_in_pool(tmp_path):
+    cache = open_render_cache(tmp_path / "cache.sqlite", 1024 * 1024)
+    try:
+        with FakeAnki() as collection:
+            with FakeFolder() as folder:
+                with open(folder / "fcard" / "other.md", "x") as f:
+                    f.write(basic_input + "\n## test\neeee")
+                collection.models.save(create_model(collection))
+                create_decks(folder, [], collection)
+                fill_decks(folder, [], collection, workers=2)
+                fill_decks(folder, [], collection, workers=2)
+
+            fcard = collection.decks.id_for_name("fcard")
+            vcard = collection.decks.id_for_name("vcard")
+            assert len(collection.find_notes(f"did:{fcard}")) == 2
+            assert len(collection.find_notes(f"did:{vcard}")) == 1
+            # The renders of the workers are cached by this process: Blahaj and test
+            assert len(cache) == 2
+    finally:
+        close_render_cache()
+
+
+def test_modified_file_batches_updates():
+    patch = """--- a/test/card.md
++++ b/test/card.md
+@@ -1,2 +1,2 @@
+ ## Blahaj
+-A lovely shark
+\\ No newline at end of file
++A lovely sharkee
+\\ No newline at end of file
+"""
+    from unidiff import PatchSet
+
+    with FakeAnki() as collection:
+        collection.models.save(create_model(collection))
+        deck_test = collection.decks.new_deck()
+        deck_test.name = "test"
+        collection.decks.add_deck(deck_test)
+        deck_test = collection.decks.by_name("test")
+        create_note(basic_input, deck_test["id"], collection.models.by_name("Ankill"), collection)
+        (nid,) = collection.find_notes(f"did:{deck_test['id']}")
+
+        changes = PlanBuilder()
+        ModifiedFile(basic_input, basic_input + "ee", PatchSet(patch)[0], "test", changes).update()
+        plan = changes.build()
+        assert [card_hash for (card_hash, _) in plan.deck("test").updates] == [Card.from_source(basic_input).hash]
+        assert collection.get_note(nid).fields[1] == "<p>A lovely shark</p>\n"
+
+        assert apply_plan(plan, collection).updated == 1
+        fields = collection.get_note(nid).fields
+        assert fields[1] == "<p>A lovely sharkee</p>\n"
+        assert fields[2] == Card.from_source(basic_input + "ee").hash
+
+
+def test_modified_file_added_card():
+    from_source = "## A\na\n\n## B\nb\n"
+    to_source = "## A\na\n\n## New\nnew\n\n## B\nb\n"
+    patch = """--- a/test/card.md
++++ b/test/card.md
+@@ -1,5 +1,8 @@
+ ## A
+ a
+ 
++## New
++new
++
+ ## B
+ b
+"""
+    from unidiff import PatchSet
+
+    changes = PlanBuilder()
+    ModifiedFile(from_source, to_source, PatchSet(patch)[0], "test", changes).update()
+    plan = changes.build().deck("test")
+    # The added card is created, not written over the card that follows it
+    assert CardIndex(to_source).file.cards[1].hash in [note[2] for note in plan.adds]
+    assert CardIndex(from_source).file.cards[1].hash not in [card_hash for (card_hash, _) in plan.updates]
+
+
+def test_apply_plan_renders_added_cards(tmp_path):
+    with FakeAnki() as collection:
+        collection.models.save(create_model(collection))
+        collection.decks.id("test")
+        changes = PlanBuilder()
+        plan_file(changes, FileChange(None, "test", None, "## Kept\nkept"), "cards")
+        assert apply_plan(changes.build(), collection).added == 1
+
+        cache = open_render_cache(tmp_path / "cache.sqlite", 1024 * 1024)
+        try:
+            changes = PlanBuilder()
+            plan_file(changes, FileChange(None, "test", None, "## New\nnew\n\n## Kept\nkept"), "cards")
+            plan = changes.build()
+            assert [note_title(note) for note in plan.deck("test").adds] == ["New", "Kept"]
+            assert len(cache) == 0
+
+            assert apply_plan(plan, collection).added == 1
+            # The card already in the deck was not rendered
+            assert len(cache) == 1
+        finally:
+            close_render_cache()
+        (nid,) = collection.find_notes("New")
+        assert collection.get_note(nid).fields[0] == "<h2>New</h2>\n"
+
+
+def test_modified_file_edited_heading():
+    from_source = "## A\na\n\n## D\nd\n\n## E\ne\n"
+    to_source = "## A\na\n\n## D2\nd\n\n## New\nnew\n\n## E\ne\n"
+    patch = """--- a/test/card.md
++++ b/test/card.md
+@@ -1,8 +1,11 @@
+ ## A
+ a
+ 
+-## D
++## D2
+ d
++
++## New
++new
+ 
+ ## E
+ e
+"""
+    from unidiff import PatchSet
+
+    changes = PlanBuilder()
+    ModifiedFile(from_source, to_source, PatchSet(patch)[0], "test", changes).update()
+    plan = changes.build().deck("test")
+    (from_cards, to_cards) = (MdFile(from_source).cards, MdFile(to_source).cards)
+    # D keeps its note, the card added after it does not take it
+    assert [(card_hash, note[2]) for (card_hash, note) in plan.updates] == [(from_cards[1].hash, to_cards[1].hash)]
+    assert [note[2] for note in plan.adds] == [to_cards[2].hash]
+    assert plan.deletes == ()
+
+
+def test_card_set_file():
+    from_source = """## Kept
+card
+
+## Edited
+card
+
+## Removed
+card
+
+## Renamed
+card
+"""
+    to_source = """## Kept
+card
+
+## Added before
+card
+
+## Edited
+cardee
+
+## Renamed again
+card
+
+## New
+card
+"""
+    with FakeAnki() as collection:
+        collection.models.save(create_model(collection))
+        deck = collection.decks.get(collection.decks.id("test"))
+        notes = DeckGenerator(deck["id"], collection).gen_decks(from_source)
+        model = collection.models.by_name("Ankill")
+        nids = add_note_to_deck(notes, model["id"], deck["id"], collection)
+
+        changes = PlanBuilder()
+        card_set = CardSetFile(from_source, to_source, "test", changes)
+        (deleted, created, updated) = card_set.changes()
+        headings = [card.source.split("\n")[0] for card in card_set.to_file.cards]
+        # Paired by heading first, then by position
+        assert [(c.source.split("\n")[0], headings[n]) for (c, n) in updated] == [
+            ("## Edited", "## Edited"), ("## Removed", "## Added before"), ("## Renamed", "## Renamed again"),
+        ]
+        assert deleted == []
+        assert [headings[n] for n in created] == ["## New"]
+        (deleted, created, _) = CardSetFile(to_source, from_source, "test", PlanBuilder()).changes()
+        assert ([c.source.split("\n")[0] for c in deleted], created) == (["## New"], [])
+        card_set.update()
+        apply_plan(changes.build(), collection)
+
+        # Each note is written once, the unchanged ones are not touched
+        fields = {collection.get_note(i).fields[0]: i for i in collection.find_notes("")}
+        assert sorted(fields) == sorted(f"<h2>{h[3:]}</h2>\n" for h in headings)
+        assert fields["<h2>Kept</h2>\n"] == nids[0]
+        assert fields["<h2>Edited</h2>\n"] == nids[1]
+        assert fields["<h2>Added before</h2>\n"] == nids[2]
+        assert fields["<h2>Renamed again</h2>\n"] == nids[3]
+        assert set(get_note_hashes(deck["id"], collection)) == {card.hash for card in MdFile(to_source).cards}
+
+
+def test_delete_file():
+    source = """## Blahaj
+the shark
+## The boykisser
+a silly cat
+"""
+    with FakeAnki() as collection:
+        collection.models.save(create_model(collection))
+        deck_test = collection.decks.new_deck()
+        deck_test.name = "test"
+        collection.decks.add_deck(deck_test)
+        deck_test = collection.decks.by_name("test")
+        model = collection.models.by_name("Ankill")
+        create_note("## Blahaj\nthe shark", deck_test["id"], model, collection)
+        create_note("## The boykisser\na silly cat", deck_test["id"], model, collection)
+        create_note("## Kept\ncard", deck_test["id"], model, collection)
+
+        changes = PlanBuilder()
+        DeleteFile(source, "test", changes).delete()
+        plan = changes.build()
+        assert len(plan.deck("test").deletes) == 2
+        assert collection.note_count() == 3
+
+        assert apply_plan(plan, collection).deleted == 2
+        assert collection.note_count() == 1
+
+
+def test_note_batch_nets_changes():
+    with FakeAnki() as collection:
+        collection.models.save(create_model(collection))
+        test = collection.decks.id("test")
+        other = collection.decks.id("other")
+        model = collection.models.by_name("Ankill")
+        create_note("## Moved file\ncard", test, model, collection)
+        create_note("## Moved deck\ncard", test, model, collection)
+        create_note("## Edited\ncard", test, model, collection)
+        hash_notes = get_note_hashes(test, collection)
+        nids = dict(hash_notes)
+        other_notes = get_note_hashes(other, collection)
+
+        batch = NoteBatch(collection)
+        for source in ("## Moved file\ncard", "## Moved deck\ncard"):
+            card_hash = Card.from_source(source).hash
+            batch.delete(hash_notes.pop(card_hash), card_hash, test)
+        for source in ("## Moved file\ncard", "## Added\ncard"):
+            batch.add(test, MdFile(source).gen_card(0), hash_notes)
+        batch.add(other, MdFile("## Moved deck\ncard").gen_card(0), other_notes)
+        edited = nids[Card.from_source("## Edited\ncard").hash]
+        batch.update(edited, MdFile("## Edited\nonce").gen_card(0))
+        batch.update(edited, MdFile("## Edited\ntwice").gen_card(0))
+
+        report = batch.write()
+        assert report == (1, 1, 0, 1, 1, 1)
+        assert collection.note_count() == 4
+        moved_file = Card.from_source("## Moved file\ncard").hash
+        moved_deck = Card.from_source("## Moved deck\ncard").hash
+        assert hash_notes[moved_file] == nids[moved_file]
+        assert other_notes[moved_deck] == nids[moved_deck]
+        assert collection.get_note(edited).fields[1] == "<p>twice</p>\n"
+        assert get_note_hashes(other, collection) == other_notes
+        assert sorted(get_note_hashes(test, collection).values()) == sorted(hash_notes.values())
+
+
+def test_git_show():
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        with open(folder / "card.md", "x") as f:
+            f.write(basic_input)
+        git.commit(["."], "initial commit")
+
+        with TempPwd(folder), Git() as g:
+            assert g.show("HEAD", "card.md") == basic_input
+            # Read in process, without git
+            assert g.batch is None
+            # Unknown to the object store, asked to git cat-file --batch alone
+            assert g.show("HEAD", "missing file.md") == ""
+            batch = g.batch
+            # The same process serves every read
+            assert g.show("HEAD", "missing file.md") == ""
+            assert g.batch is batch
+
+            batch.kill()
+            batch.wait()
+            assert g.show("HEAD", "missing file.md") == ""
+            assert g.batch is not batch
+        assert g.batch is None
+
+
+def test_object_store():
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        os.mkdir(folder / "fcard")
+        content = "\n\n".join(f"## Card {i}\nAnswer {i}" for i in range(200))
+        for i in range(5):
+            # Small edits of a big file, stored as deltas once packed
+            content += f"\n\n## Edit {i}\nAnswer"
+            with open(folder / "fcard" / "card.md", "w") as f:
+                f.write(content)
+            git.commit(["."], f"edit {i}")
+        with TempPwd(folder):
+            subprocess.run(["git", "tag", "-a", "-m", "v1", "v1", "HEAD~1"], capture_output=True, check=True)
+
+        def check(store):
+            with TempPwd(folder):
+                p = subprocess.run(["git", "rev-list", "--objects", "--all"], capture_output=True)
+                oids = [line.split(" ")[0] for line in p.stdout.decode("utf-8").splitlines()]
+                for oid in oids:
+                    kind = subprocess.run(["git", "cat-file", "-t", oid], capture_output=True).stdout.strip()
+                    raw = subprocess.run(["git", "cat-file", kind.decode("utf-8"), oid], capture_output=True).stdout
+                    assert store.read(oid) == (kind, raw)
+
+            head = store.resolve("HEAD")
+            assert store.resolve("master") == head
+            assert store.resolve(head[:7]) == head
+            assert store.resolve("HEAD~4^0") == store.resolve("HEAD^^^^")
+            assert store.resolve("HEAD~5") is None
+            # Annotated tags are peeled, like git rev-parse v1^{commit}
+            assert store.resolve("v1") == store.resolve("HEAD~1")
+            assert store.resolve("v1~1") == store.resolve("HEAD~2")
+            assert [e.name for e in store.tree("HEAD")] == ["fcard"]
+            assert store.cat("HEAD:fcard/card.md").decode("utf-8") == content
+            assert store.cat("HEAD:fcard/missing.md") is None
+
+        check(ObjectStore.find(str(folder)))
+        with TempPwd(folder):
+            subprocess.run(["git", "gc", "-q", "--aggressive"], capture_output=True)
+            subprocess.run(["git", "pack-refs", "--all"], capture_output=True)
+        assert not os.path.exists(folder / ".git" / "refs" / "heads" / "master")
+        store = ObjectStore.find(str(folder))
+        check(store)
+        store.close()
+
+        with TempPwd(folder), Git() as g:
+            assert g.show("HEAD~1", "fcard/card.md") == content[:-len("\n\n## Edit 4\nAnswer")]
+            assert g.batch is None
+            assert g.rev_parse("HEAD") == g.rev_parse("master")
+            tagged = subprocess.run(["git", "rev-parse", "v1^{commit}"], capture_output=True).stdout.decode().strip()
+            assert g.rev_parse("v1") == tagged
+            assert [e.name for e in g.ls_tree("HEAD", "fcard")] == ["card.md"]
+
+        class BrokenStore:
+            """
+            A store failing on every object, like one meeting a corrupt pack
+            """
+            def __getattr__(self, name):
+                def fail(*args):
+                    raise zlib.error("corrupt")
+                return fail
+
+            def close(self):
+                pass
+
+        with TempPwd(folder), Git() as g:
+            g.store = BrokenStore()
+            assert g.rev_parse("v1") == tagged
+            assert [e.name for e in g.ls_tree("HEAD", "fcard")] == ["card.md"]
+            assert g.show("HEAD", "fcard/card.md") == content
+            assert g.show_many(["HEAD:fcard/card.md"]) == {"HEAD:fcard/card.md": content}
+
+
+def test_async_git():
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        for i in range(10):
+            with open(folder / f"card{i}.md", "x") as f:
+                f.write(f"## Card {i}\nAnswer {i}")
+        git.commit(["."], "initial commit")
+        for i in range(10):
+            with open(folder / f"card{i}.md", "a") as f:
+                f.write(" edited")
+        git.commit(["."], "edit")
+
+        names = [f"HEAD:card{i}.md" for i in range(10)] + ["HEAD:missing.md"]
+        shown = {f"HEAD:card{i}.md": f"## Card {i}\nAnswer {i} edited" for i in range(10)}
+        shown["HEAD:missing.md"] = ""
+        with TempPwd(folder):
+            oids = [
+                tuple(subprocess.run(["git", "rev-parse", f"{rev}:card{i}.md"], capture_output=True)
+                      .stdout.decode().strip() for rev in ("HEAD~1", "HEAD"))
+                for i in range(10)
+            ]
+            diffs = run_sync(AsyncGit(concurrency=3).diff_blobs_many(oids))
+            assert "+Answer 4 edited" in diffs[oids[4]]
+
+            async def from_a_loop():
+                # The synchronous facade also works from inside an event loop
+                with Git() as g:
+                    return (g.show_many(names), g.diff_blobs_many(oids))
+
+            assert run_sync(from_a_loop()) == (shown, diffs)
+            with Git() as g:
+                assert g.show_many(names) == shown
+                # Without the store, through the persistent cat-file process in one pass
+                g.store = False
+                assert g.show_many(names) == shown
+                batch = g.batch
+                assert batch is not None
+                assert g.show_many(names[::-1]) == shown
+                assert g.batch is batch
+
+
+def test_partial_clone():
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        os.makedirs(folder / "fcard" / "sub")
+        os.mkdir(folder / "other")
+        for (path, content) in [("fcard/card.md", basic_input), ("fcard/sub/sub.md", "## Sub\ncard"),
+                                ("fcard/image.png", "not a card"), ("other/card.md", basic_input)]:
+            with open(folder / path, "x") as f:
+                f.write(content)
+        git.commit(["."], "initial commit")
+        with open(folder / "fcard" / "card.md", "a") as f:
+            f.write("ee")
+        git.commit(["."], "Update note")
+        subprocess.run(["git", "-C", str(folder), "config", "uploadpack.allowfilter", "true"])
+
+        clone = pathlib.Path("./fake_git_clone")
+        try:
+            Git().clone(f"file://{folder.absolute()}", str(clone), filter="blob:none", depth=1,
+                        sparse=sparse_patterns(["fcard"]))
+            checked_out = sorted(
+                str(p.relative_to(clone)) for p in clone.rglob("*") if p.is_file() and ".git" not in p.parts
+            )
+            assert checked_out == ["fcard/card.md", "fcard/sub/sub.md"]
+
+            with TempPwd(clone), Git() as g:
+                assert g.rev_parse("HEAD~1") is None
+                # Not checked out, so not downloaded yet
+                oid = g.store.lookup("HEAD:fcard/image.png")
+                assert g.store.read(oid) is None
+                assert g.show_many(["HEAD:fcard/image.png", "HEAD:other/card.md"]) == {
+                    "HEAD:fcard/image.png": "not a card",
+                    "HEAD:other/card.md": basic_input,
+                }
+                assert g.store.read(oid) is not None
+        finally:
+            shutil.rmtree(clone, ignore_errors=True)
+
+
+def test_iter_patched_files():
+    from unidiff import PatchSet
+
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        for i in range(5):
+            with open(folder / f"card{i}.md", "x") as f:
+                f.write(f"## Card {i}\nAnswer {i}\n")
+        git.commit(["."], "initial commit")
+        for i in range(5):
+            with open(folder / f"card{i}.md", "a") as f:
+                f.write("ee\n")
+        os.remove(folder / "card4.md")
+        git.commit(["."], "Update notes")
+
+        with TempPwd(folder):
+            lines = list(Git().diff_lines("HEAD~1", "HEAD"))
+            expected = PatchSet(Git().diff("HEAD~1", "HEAD"))
+
+        read = []
+
+        def reading():
+            for line in lines:
+                read.append(line)
+                yield line
+
+        files = iter_patched_files(reading())
+        first = next(files)
+        assert first.path == "card0.md"
+        # Only the first file was read
+        assert len(read) < len(lines) / 2
+        assert [str(first)] + [str(f) for f in files] == [str(f) for f in expected]
+        assert len(read) == len(lines)
+
+
+def test_deck_pathspecs():
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        subprocess.run(["git", "-C", str(folder), "commit", "--allow-empty", "-m", "initial commit"])
+        for deck in ("fcard", "other", "fcard/sub"):
+            os.makedirs(folder / deck, exist_ok=True)
+            with open(folder / deck / "card.md", "x") as f:
+                f.write(basic_input)
+        for path in ("readme.md", "fcard/image.png"):
+            with open(folder / path, "x") as f:
+                f.write("not a card")
+        git.commit(["."], "Add cards")
+
+        with TempPwd(folder), Git() as g:
+            def paths(pathspecs):
+                return sorted(c.new_path for c in g.diff_raw("HEAD~1", "HEAD", pathspecs))
+
+            assert paths(deck_pathspecs()) == ["fcard/card.md", "fcard/sub/card.md", "other/card.md"]
+            assert paths(deck_pathspecs(["other"])) == ["other/card.md"]
+            assert paths(deck_pathspecs(exclude=["other"])) == ["fcard/card.md", "fcard/sub/card.md"]
+            assert [f.path for f in iter_patched_files(g.diff_lines("HEAD~1", "HEAD", deck_pathspecs(["fcard"])))] == [
+                "fcard/card.md", "fcard/sub/card.md",
+            ]
+
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        subprocess.run(["git", "-C", str(folder), "commit", "--allow-empty", "-m", "initial commit"])
+        # Deck names which are globs of other decks
+        for deck in ("C++ [2024]", "C++ 2", "Q?A", "QxA"):
+            os.makedirs(folder / deck)
+            with open(folder / deck / "card.md", "x") as f:
+                f.write(basic_input)
+        git.commit(["."], "Add cards")
+
+        with TempPwd(folder), Git() as g:
+            def paths(pathspecs):
+                return sorted(c.new_path for c in g.diff_raw("HEAD~1", "HEAD", pathspecs))
+
+            assert paths(deck_pathspecs(["C++ [2024]", "Q?A"])) == ["C++ [2024]/card.md", "Q?A/card.md"]
+            assert paths(deck_pathspecs(exclude=["C++ [2024]", "Q?A"])) == ["C++ 2/card.md", "QxA/card.md"]
+
+    with FakeAnki() as collection, FakeGitRepo() as folder:
+        collection.models.save(create_model(collection))
+        for deck in ("fcard", "other"):
+            os.mkdir(folder / deck)
+            with open(folder / deck / "card.md", "x") as f:
+                f.write(f"## {deck}\ncard")
+        create_decks(folder, [], collection, exclude=["other"])
+        fill_decks(folder, [], collection, exclude=["other"])
+        assert collection.decks.by_name("other") is None
+        assert len(collection.find_notes("")) == 1
+
+
+def test_blob_cache(tmp_path):
+    cache = BlobCache(max_bytes=10, path=tmp_path / "blobs.sqlite", disk_max_bytes=25)
+    cache.put("a" * 40, b"0123456789")
+    cache.put("b" * 40, b"0123456789")
+    # Only the last one fits in memory, both on disk
+    assert list(cache.blobs) == ["b" * 40]
+    assert cache.get("a" * 40) == b"0123456789"
+    cache.put("c" * 40, b"0123456789")
+    assert cache.get("b" * 40) is None
+    assert len(cache) == 2
+    cache.close()
+
+    cache = BlobCache(path=tmp_path / "blobs.sqlite")
+    assert cache.get("a" * 40) == b"0123456789"
+    cache.close()
+
+
+def test_git_show_uses_blob_cache(tmp_path):
+    def blob_oid(name: str) -> str:
+        return subprocess.run(["git", "rev-parse", name], capture_output=True).stdout.decode().strip()
+
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        for name in ("card.md", "other.md"):
+            with open(folder / name, "x") as f:
+                f.write(f"{basic_input} in {name}" if name == "other.md" else basic_input)
+        git.commit(["."], "initial commit")
+
+        cache = open_blob_cache(tmp_path / "blobs.sqlite", 1024)
+        try:
+            with TempPwd(folder), Git() as g:
+                oid = blob_oid("HEAD:card.md")
+                assert cache.get(oid) is None
+                assert g.show("HEAD", "card.md") == basic_input
+                assert cache.get(oid) == bytes(basic_input, "utf-8")
+
+                # Served from the cache, not from the repository
+                other = blob_oid("HEAD:other.md")
+                cache.put(other, b"cached")
+                assert g.show("HEAD", "other.md") == "cached"
+                assert g.show_many(["HEAD:other.md"]) == {"HEAD:other.md": "cached"}
+        finally:
+            close_blob_cache()
+
+
+def test_git_diff_raw():
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        for name in ("kept.md", "removed.md", "moved.md"):
+            with open(folder / name, "x") as f:
+                f.write(f"{basic_input}\n\n## {name}\ncontent of {name}")
+        git.commit(["."], "initial commit")
+
+        with open(folder / "kept.md", "a") as f:
+            f.write("ee")
+        with open(folder / "added.md", "x") as f:
+            f.write(basic_input)
+        os.remove(folder / "removed.md")
+        os.rename(folder / "moved.md", folder / "moved again.md")
+        git.commit(["."], "Update notes")
+
+        with TempPwd(folder), Git() as g:
+            changes = {change.new_path: change for change in g.diff_raw("HEAD~1", "HEAD")}
+            assert {path: change.status for (path, change) in changes.items()} == {
+                "kept.md": "M",
+                "added.md": "A",
+                "removed.md": "D",
+                "moved again.md": "R",
+            }
+            assert changes["moved again.md"].old_path == "moved.md"
+            assert g.blob(changes["added.md"].new_oid) == basic_input
+            kept = changes["kept.md"]
+            assert g.blob(kept.new_oid) == g.blob(kept.old_oid) + "ee"
+
+
+def test_diff_raw_source():
+    def sync(source, strategy="hunks", workers=0):
+        with FakeAnki() as collection, FakeGitRepo() as folder:
+            collection.models.save(create_model(collection))
+            git = GitHandler(folder)
+
+            os.mkdir(folder / "fcard")
+            for name in ("card.md", "removed.md"):
+                with open(folder / "fcard" / name, "x") as f:
+                    f.write(f"## Title of {name}\nA card\n\n## {name}\ncontent of {name}")
+            git.commit(["."], "initial commit")
+
+            create_decks(folder, [], collection)
+            fill_decks(folder, [], collection)
+
+            with open(folder / "fcard" / "card.md", "a") as f:
+                f.write("ee")
+            with open(folder / "fcard" / "added.md", "x") as f:
+                f.write("## Added\nA new card")
+            os.remove(folder / "fcard" / "removed.md")
+            git.commit(["."], "Update notes")
+
+            with TempPwd(folder):
+                Diff("HEAD~1", "HEAD", collection, source, strategy=strategy, workers=workers).update_deck_and_notes()
+
+            did = collection.decks.by_name("fcard")["id"]
+            return sorted(
+                tuple(collection.get_note(i).fields) for i in collection.find_notes(f"did:{did}")
+            )
+
+    notes = sync("raw")
+    assert notes == sync("patch")
+    assert notes == sync("raw", "cards")
+    assert notes == sync("patch", "cards")
+    assert notes == sync("patch", "hunks", workers=2)
+    assert notes == sync("raw", "cards", workers=2)
+    assert [recto for (recto, _, _) in notes] == [
+        "<h2>Added</h2>\n", "<h2>Title of card.md</h2>\n", "<h2>card.md</h2>\n",
+    ]
+    assert "<p>content of card.mdee</p>\n" in [verso for (_, verso, _) in notes]
+
+
+def test_diff_hunks_remove_card():
+    cards = [f"## {name}\n{name.lower()}\n" for name in "ABCDEFG"]
+    with FakeAnki() as collection, FakeGitRepo() as folder:
+        collection.models.save(create_model(collection))
+        git = GitHandler(folder)
+        os.mkdir(folder / "fcard")
+        with open(folder / "fcard" / "card.md", "x") as f:
+            f.write("\n".join(cards))
+        git.commit(["."], "initial commit")
+        create_decks(folder, [], collection)
+        fill_decks(folder, [], collection)
+
+        with open(folder / "fcard" / "card.md", "w") as f:
+            f.write("\n".join(cards[:3] + cards[4:]))
+        git.commit(["."], "Remove D")
+
+        with TempPwd(folder):
+            report = Diff("HEAD~1", "HEAD", collection, strategy="hunks").update_deck_and_notes()
+
+        assert (report.added, report.updated, report.deleted) == (0, 0, 1)
+        did = collection.decks.by_name("fcard")["id"]
+        rectos = sorted(collection.get_note(i).fields[0] for i in collection.find_notes(f"did:{did}"))
+        assert rectos == [f"<h2>{name}</h2>\n" for name in "ABCEFG"]
+
+
+def test_diff_plan(tmp_path):
+    with FakeGitRepo() as folder:
+        git = GitHandler(folder)
+        os.mkdir(folder / "fcard")
+        os.mkdir(folder / "vcard")
+        with open(folder / "fcard" / "card.md", "x") as f:
+            f.write("## Kept\nA card\n\n## Removed\nA card")
+        with open(folder / "fcard" / "moved.md", "x") as f:
+            f.write("## Moved\nA card")
+        git.commit(["."], "initial commit")
+
+        with open(folder / "fcard" / "card.md", "w") as f:
+            f.write("## Kept\nA card\n\n## Added\nA card")
+        os.rename(folder / "fcard" / "moved.md", folder / "vcard" / "moved.md")
+        git.commit(["."], "Update notes")
+
+        with TempPwd(folder):
+            plan = Diff("HEAD~1", "HEAD", strategy="cards").plan()
+            cache = open_render_cache(tmp_path / "cache.sqlite", 1024 * 1024)
+            try:
+                assert Diff("HEAD~1", "HEAD", strategy="cards", workers=2).plan() == plan
+                # The renders of the workers are cached by this process: Added
+                assert len(cache) == 1
+            finally:
+                close_render_cache()
+            assert Diff("HEAD~1", "HEAD", strategy="cards").plan(["vcard"]).deck("fcard") == ((), (), ())
+
+        assert plan.moves == (("fcard", "vcard", Card.from_source("## Moved\nA card").hash),)
+        assert [deck for (deck, _) in plan.decks] == ["fcard"]
+        ((removed, note),) = plan.deck("fcard").updates
+        assert removed == Card.from_source("## Removed\nA card").hash
+        assert note[0] == "<h2>Added</h2>\n"
+        assert str(plan).splitlines()[2:] == ["fcard: 0 added, 1 updated, 0 deleted", "  ~ Added"]
+
+
+def test_fetch_repo():
+    with FakeAnki() as collection, FakeGitRepo() as folder:
+        collection.models.save(create_model(collection))
+        git = GitHandler(folder)
+        os.mkdir(folder / "fcard")
+        with open(folder / "fcard" / "card.md", "x") as f:
+            f.write(basic_input)
+        git.commit(["."], "initial commit")
+
+        clone = pathlib.Path("./fake_git_clone")
+        try:
+            Git().clone(f"file://{folder.absolute()}", str(clone))
+            create_decks(clone, [], collection)
+            fill_decks(clone, [], collection)
+
+            with open(folder / "fcard" / "card.md", "a") as f:
+                f.write("ee")
+            git.commit(["."], "Update note")
+
+            with TempPwd(clone):
+                x = fetch_repo()
+                assert x is not None
+                # Nothing is checked out before the cards are updated
+                with open("fcard/card.md") as f:
+                    assert f.read() == basic_input
+
+                refresh_card(x, collection=collection)
+                assert Git().fast_forward(x[1])
+                with open("fcard/card.md") as f:
+                    assert f.read() == basic_input + "ee"
+                assert fetch_repo() is None
+        finally:
+            shutil.rmtree(clone, ignore_errors=True)
+
+        did = collection.decks.by_name("fcard")["id"]
+        notes = [collection.get_note(i).fields[1] for i in collection.find_notes(f"did:{did}")]
+        assert notes == ["<p>A lovely sharkee</p>\n"]
+
+
+def test_diff_renames():
+    def sync(source):
+        with FakeAnki() as collection, FakeGitRepo() as folder:
+            collection.models.save(create_model(collection))
+            git = GitHandler(folder)
+            for deck in ("fcard", "other"):
+                os.mkdir(folder / deck)
+            with open(folder / "fcard" / "moved.md", "x") as f:
+                f.write("## Moved 1\ncard\n\n## Moved 2\ncard\n")
+            with open(folder / "fcard" / "renamed.md", "x") as f:
+                f.write("\n\n".join(f"## Renamed {i}\ncard" for i in range(10)))
+            with open(folder / "other" / "card.md", "x") as f:
+                f.write(basic_input)
+            git.commit(["."], "initial commit")
+
+            create_decks(folder, [], collection)
+            fill_decks(folder, [], collection)
+            nids = {collection.get_note(i).fields[0]: i for i in collection.find_notes("")}
+
+            with TempPwd(folder):
+                subprocess.run(["git", "mv", "fcard/moved.md", "other/moved.md"])
+                subprocess.run(["git", "mv", "fcard/renamed.md", "fcard/edited.md"])
+            with open(folder / "fcard" / "edited.md", "a") as f:
+                f.write("ee")
+            git.commit(["."], "Move notes")
+
+            with TempPwd(folder):
+                Diff("HEAD~1", "HEAD", collection, source).update_deck_and_notes()
+
+            decks = {}
+            for nid in collection.find_notes(""):
+                note = collection.get_note(nid)
+                deck = collection.decks.name(note.cards()[0].did)
+                decks[note.fields[0]] = (deck, note.fields[1], nid)
+            return (nids, decks)
+
+    for source in ("patch", "raw"):
+        (nids, decks) = sync(source)
+        assert len(decks) == 13
+        # Moved with their review history, not recreated
+        assert decks["<h2>Moved 1</h2>\n"] == ("other", "<p>card</p>\n", nids["<h2>Moved 1</h2>\n"])
+        assert decks["<h2>Moved 2</h2>\n"][0] == "other"
+        assert decks["<h2>Renamed 0</h2>\n"] == ("fcard", "<p>card</p>\n", nids["<h2>Renamed 0</h2>\n"])
+        assert decks["<h2>Renamed 9</h2>\n"][0:2] == ("fcard", "<p>cardee</p>\n")
+
+
 def test_diff_check():
     with FakeAnki() as collection:
         with FakeGitRepo() as folder:
@@ -368,7 +1446,7 @@ def test_diff_check():
 
             git.commit(["."], "Update note")
             lines = [
-                line.lstrip("commit ")
+                line.split()[1]
                 for line in git.log().splitlines()
                 if line.startswith("commit")
             ]
@@ -402,7 +1480,7 @@ def test_diff_remove():
             os.remove(folder / "fcard" / "card.md")
             git.commit(["."], "Update note")
             lines = [
-                line.lstrip("commit ")
+                line.split()[1]
                 for line in git.log().splitlines()
                 if line.startswith("commit")
             ]
@@ -436,7 +1514,7 @@ def test_diff_add_file():
 
             git.commit(["."], "Update note")
             lines = [
-                line.lstrip("commit ")
+                line.split()[1]
                 for line in git.log().splitlines()
                 if line.startswith("commit")
             ]
@@ -471,7 +1549,7 @@ Les hommes naissent et demeurent libres et égaux en droits, les distinctions so
 
             git.commit(["."], "Update note")
             lines = [
-                line.lstrip("commit ")
+                line.split()[1]
                 for line in git.log().splitlines()
                 if line.startswith("commit")
             ]
@@ -483,7 +1561,11 @@ Les hommes naissent et demeurent libres et égaux en droits, les distinctions so
         deckdict = collection.decks.by_name("fcard")
         did = deckdict["id"]
 
-        assert len(collection.find_notes(f"did:{did}")) == 3
+        # Blahaj is updated, its card now ends with blank lines, and Article I is added
+        notes = sorted(collection.get_note(nid).fields[:2] for nid in collection.find_notes(f"did:{did}"))
+        assert [recto for (recto, _) in notes] == ["<h2>Article I</h2>\n", "<h2>Blahaj</h2>\n"]
+        assert notes[0][1].startswith("<p>Les hommes naissent")
+        assert notes[1][1] == "<p>A lovely shark</p>\n"
 
 
 def test_mdanki_migration():